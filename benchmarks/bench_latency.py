@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-call latency of para2geom for small batches: Keras `Model.predict` (as used
+before), the compiled fixed-signature call and the NumPy backend
+
+Usage: python benchmarks/bench_latency.py [--batch 1 2 4 8 16 64] [--calls 200]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from ml import MODEL_FILES, NumpyModel, load_para2geom, resource_path  # noqa: E402
+
+
+def latency(function, x, calls: int) -> tuple:
+    # Median and 95th percentile of single calls, in microseconds
+    times = np.empty(calls)
+    for i in range(calls):
+        start = time.perf_counter()
+        function(x)
+        times[i] = time.perf_counter() - start
+    return np.median(times) * 1e6, np.percentile(times, 95) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 2, 4, 8, 16, 64])
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    compiled, _ = load_para2geom("keras")
+    numpy_model = NumpyModel.from_h5(resource_path(*MODEL_FILES["para2geom"]))
+    paths = {
+        "predict": lambda x: compiled.model.predict(x, verbose=0),
+        "compiled": compiled.predict,
+        "numpy": numpy_model.predict,
+    }
+
+    print(f"{'batch':>6}" + "".join(f"{name + ' (us)':>22}" for name in paths))
+    rng = np.random.default_rng(0)
+    for batch in args.batch:
+        x = rng.uniform(-3, 3, (batch, 3)).astype(np.float32)
+        reference = paths["predict"](x)
+        tolerance = 1e-5 * np.abs(reference).max()
+        row = f"{batch:>6}"
+        for name, function in paths.items():
+            # The first call also serves as warm-up
+            assert np.abs(function(x) - reference).max() <= tolerance, name
+            median, p95 = latency(function, x, args.calls)
+            row += f"{f'{median:.0f} (p95 {p95:.0f})':>22}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the ML geometry pipeline: end to end and per stage, for Thin
+Wall and Cube settings over a range of batch sizes, written to JSON
+
+Usage: python benchmarks/bench_ml.py [--sizes 1 10 100 1000 10000] [--output bench.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from bench_workers import sample_rows  # noqa: E402
+from ml import (  # noqa: E402
+    clear_stage_caches,
+    mask_extremes,
+    meltpool_geom_cal_batch,
+    model_hash,
+    models,
+    porosity_search,
+    resize_dim,
+    rotate_aoi,
+    tile_tracks,
+)
+
+# Settings used by generate_gcode for each shape
+SHAPES = {"Thin Wall": 1, "Cube": 5}
+NUM_LAYERS = 3
+
+
+class Timer:
+    # Accumulates wall time per stage name
+    def __init__(self) -> None:
+        self.seconds = {}
+
+    def __call__(self, name: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+        return result
+
+
+def stage_times(power, speed, rpm, hatch_spacing, num_tracks) -> dict:
+    # The steps of meltpool_geom_cal_batch one by one, without memoization
+    timer = Timer()
+    input_sc = timer(
+        "scaling", models.sc.transform, np.column_stack((power, rpm, speed))
+    )
+    mp = timer("predict", models.para2geom.predict, input_sc, verbose=0)
+    mp = timer("pca_inverse", models.para2geom_pca.inverse_transform, mp)
+    mp_true = timer("threshold", lambda: (mp > 127).reshape(-1, *resize_dim))
+    width, height = timer("extremes", mask_extremes, mp_true)
+    features = np.column_stack(
+        (width / 96 * 550, speed, hatch_spacing, height / 96 * 550)
+    )
+    angle = timer("hs2angle", models.hs2angle.predict, features)
+    iterations = 0
+    for i in range(len(mp_true)):
+        rotated_aoi_mask, rotated_mp_height, rotated_width = timer(
+            "rotation", rotate_aoi, mp_true[i], angle[i]
+        )
+        surface = timer(
+            "tiling",
+            tile_tracks,
+            rotated_aoi_mask,
+            rotated_width,
+            hatch_spacing[i],
+            num_tracks,
+        )
+        _, evaluated = timer(
+            "porosity",
+            porosity_search,
+            surface,
+            rotated_mp_height,
+            NUM_LAYERS,
+        )
+        iterations += evaluated
+    return {"seconds": timer.seconds, "porosity_iterations": iterations}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000]
+    )
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_ml.json")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    models.load()
+    load_time = time.perf_counter() - start
+
+    results = []
+    for shape in args.shapes:
+        for size in args.sizes:
+            rows = sample_rows(size, seed=args.seed)
+            clear_stage_caches()
+            start = time.perf_counter()
+            meltpool_geom_cal_batch(
+                *rows,
+                num_tracks=SHAPES[shape],
+                num_layers=NUM_LAYERS,
+                workers=args.workers,
+            )
+            end_to_end = time.perf_counter() - start
+            stages = stage_times(*rows, SHAPES[shape])
+            results.append(
+                {
+                    "shape": shape,
+                    "num_tracks": SHAPES[shape],
+                    "batch_size": size,
+                    "end_to_end_s": end_to_end,
+                    "rows_per_s": size / end_to_end,
+                    "stages_s": stages["seconds"],
+                    "porosity_iterations": stages["porosity_iterations"],
+                }
+            )
+            print(
+                f"{shape:>9} {size:>6} rows: {end_to_end:8.3f} s "
+                f"({size / end_to_end:8.1f} rows/s)"
+            )
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "backend": models.active_backend,
+        "model_hash": model_hash(),
+        "model_load_s": load_time,
+        "workers": args.workers,
+        "seed": args.seed,
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
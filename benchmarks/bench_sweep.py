@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time of a hatch spacing sweep with `meltpool_geom_sweep` against calling
+`meltpool_geom_cal` once per spacing
+
+Usage: python benchmarks/bench_sweep.py [--spacings 10 20] [--points 5]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from bench_workers import sample_rows  # noqa: E402
+from ml import (  # noqa: E402
+    clear_stage_caches,
+    meltpool_geom_cal,
+    meltpool_geom_sweep,
+    models,
+)
+
+
+def loop(point, spacings, memoized, **kwargs) -> np.ndarray:
+    # One call per spacing; without `memoized` every call starts from cold caches
+    results = []
+    for hatch_spacing in spacings:
+        if not memoized:
+            clear_stage_caches()
+        results.append(meltpool_geom_cal(*point, hatch_spacing, **kwargs))
+    return np.array(results).T
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--spacings", type=int, nargs="+", default=[10, 20])
+    parser.add_argument("--points", type=int, default=5)
+    parser.add_argument("--min", type=float, default=0.2)
+    parser.add_argument("--max", type=float, default=0.6)
+    parser.add_argument("--num-tracks", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    models.load()
+    kwargs = dict(num_tracks=args.num_tracks, num_layers=3)
+    power, speed, rpm, _ = sample_rows(args.points, args.seed)
+    paths = ("loop (s)", "memoized loop (s)", "sweep (s)")
+    print(f"{'spacings':>8}" + "".join(f"{name:>20}" for name in paths))
+    for n in args.spacings:
+        spacings = np.linspace(args.min, args.max, n)
+        times = np.zeros(len(paths))
+        for point in zip(power, speed, rpm):
+            for i, memoized in enumerate((False, True)):
+                clear_stage_caches()
+                start = time.perf_counter()
+                expected = loop(point, spacings, memoized, **kwargs)
+                times[i] += time.perf_counter() - start
+            clear_stage_caches()
+            start = time.perf_counter()
+            result = meltpool_geom_sweep(*point, spacings, **kwargs)
+            times[2] += time.perf_counter() - start
+            assert np.allclose(result, expected, rtol=1e-9, atol=0)
+        print(f"{n:>8}" + "".join(f"{t / args.points:>20.3f}" for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time of `tile_tracks` against the number of tracks, compared with placing the
+tracks one at a time
+
+Usage: python benchmarks/bench_tiling.py [--tracks 1 2 5 10 20 50] [--hatch 0.3 0.6]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from ml import bounding_box, tile_tracks  # noqa: E402
+
+
+def tile_tracks_loop(rotated_aoi_mask, rotated_width, hatch_spacing, num_tracks):
+    # Previous implementation: one slice update per track
+    spacing = rotated_width * hatch_spacing
+    patterned_image = np.zeros(
+        (
+            rotated_aoi_mask.shape[0],
+            int((num_tracks - 1) * spacing) + rotated_aoi_mask.shape[1],
+        ),
+        bool,
+    )
+    for i in range(num_tracks):
+        x_offset = int(i * spacing)
+        patterned_image[:, x_offset : x_offset + rotated_aoi_mask.shape[1]] |= (
+            rotated_aoi_mask
+        )
+    y_min, x_min, y_max, x_max = bounding_box(patterned_image)
+    return patterned_image[y_min:y_max, x_min:x_max]
+
+
+def melt_pool_mask(width: int = 70, height: int = 30) -> np.ndarray:
+    # Half ellipse, about the size of a rotated 96x96 prediction
+    y, x = np.mgrid[:height, :width]
+    return ((x - width / 2) / (width / 2)) ** 2 + (y / height) ** 2 < 1
+
+
+def best_time(function, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tracks", type=int, nargs="+", default=[1, 2, 5, 10, 20, 50])
+    parser.add_argument("--hatch", type=float, nargs="+", default=[0.3, 0.6])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    mask = melt_pool_mask()
+    width = mask.shape[1] - 1.0
+    print(f"{'hatch':>6} {'tracks':>6} {'loop (us)':>10} {'kernel (us)':>12}")
+    for hatch in args.hatch:
+        for tracks in args.tracks:
+            expected = tile_tracks_loop(mask, width, hatch, tracks)
+            assert np.array_equal(tile_tracks(mask, width, hatch, tracks), expected)
+            loop = best_time(
+                lambda: tile_tracks_loop(mask, width, hatch, tracks), args.repeat
+            )
+            kernel = best_time(
+                lambda: tile_tracks(mask, width, hatch, tracks), args.repeat
+            )
+            print(f"{hatch:>6} {tracks:>6} {loop * 1e6:>10.1f} {kernel * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rows/s of `meltpool_geom_cal_batch` against the number of worker processes
+
+Usage: python benchmarks/bench_workers.py [--rows 2000] [--workers 1 2 4 8 16]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from ml import (  # noqa: E402
+    clear_stage_caches,
+    meltpool_geom_cal_batch,
+    models,
+    shutdown_process_pool,
+)
+
+
+def sample_rows(n: int, seed: int) -> tuple:
+    # Uniform samples within the ranges of the example CSV
+    data = pd.read_csv(ROOT / "docs" / "example" / "example.csv")
+    rng = np.random.default_rng(seed)
+    columns = {
+        "power": data["laser_power"],
+        "speed": data["scanning_speed"],
+        "rpm": data["rpm_1"] + data["rpm_2"],
+        "hatch_spacing": data["hatch_spacing"],
+    }
+    return tuple(
+        rng.uniform(column.min(), column.max(), n) for column in columns.values()
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--tracks", type=int, default=5)
+    args = parser.parse_args()
+
+    models.load()
+    print(f"{'workers':>8} {'seconds':>10} {'rows/s':>10} {'speedup':>8}")
+    baseline = None
+    for seed, workers in enumerate(args.workers):
+        # Start the pool first so that process start-up is not timed, then use
+        # fresh rows so that no stage cache is warm
+        clear_stage_caches()
+        meltpool_geom_cal_batch(
+            *sample_rows(2 * workers, seed=1000 + seed),
+            num_tracks=args.tracks,
+            workers=workers,
+        )
+        rows = sample_rows(args.rows, seed=seed)
+        start = time.perf_counter()
+        meltpool_geom_cal_batch(*rows, num_tracks=args.tracks, workers=workers)
+        elapsed = time.perf_counter() - start
+        shutdown_process_pool()
+
+        rate = args.rows / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>8} {elapsed:>10.3f} {rate:>10.1f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
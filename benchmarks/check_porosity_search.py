@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the `t_ratio` of `porosity_search` against the original loop
+
+Usage: python benchmarks/check_porosity_search.py [--cases 500] [--csv docs/example/example.csv]
+
+Surfaces come from synthetic melt pools, or with `--csv` from the ML predictions
+for the rows of a G.L.O.W. CSV (this needs the models). The surfaces where the
+search differs from the loop are listed, and the exit status is then 1.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from ml import (  # noqa: E402
+    angle_stage,
+    mask_stage,
+    models,
+    porosity_search,
+    rotate_aoi,
+    tile_tracks,
+)
+
+
+def porosity_loop(surface, layer_height, num_layers, surface_padding=0):
+    # Original implementation, stopped once t_ratio reaches 0 where it used to run
+    # on into negative layer thicknesses
+    surface_mask = (surface > 0).astype(np.uint8)
+    t_ratio = 1
+    counter = 0
+    while t_ratio > 1e-9:
+        cube = np.zeros((1000, surface.shape[1]))
+        cube_to_check = np.zeros((1000, surface.shape[1]))
+        layer_t = int(layer_height * t_ratio)
+        for i in range(num_layers):
+            total_height = num_layers * surface.shape[0]
+            roi = cube[
+                total_height - surface.shape[0] - layer_t * i : total_height
+                - layer_t * i,
+                : surface.shape[1],
+            ]
+            roi_to_check = cube_to_check[
+                total_height - surface.shape[0] - layer_t * i : total_height
+                - surface.shape[0]
+                - layer_t * i
+                + surface_mask[0 : int(layer_height) + surface_padding, :].shape[0],
+                : surface.shape[1],
+            ]
+            np.copyto(roi, surface, where=surface_mask.astype(bool))
+            np.copyto(
+                roi_to_check,
+                surface[0 : int(layer_height) + surface_padding, :],
+                where=surface_mask[0 : int(layer_height) + surface_padding, :].astype(
+                    bool
+                ),
+            )
+            surface = np.fliplr(surface)
+            surface_mask = np.fliplr(surface_mask)
+        coords_cube = np.argwhere(cube)
+        y_min_cube, x_min_cube = coords_cube.min(axis=0)
+        y_max_cube, x_max_cube = coords_cube.max(axis=0)
+        cube = cube[(y_min_cube - 1) : (y_max_cube + 1), x_min_cube : (x_max_cube + 1)]
+        cube_to_check = cube_to_check[
+            (y_min_cube - 1) : (y_max_cube + 1), x_min_cube : (x_max_cube + 1)
+        ]
+        cube_to_check_centre = cube_to_check[
+            int(cube.shape[0] * 0.25) : int(cube.shape[0] * 0.75),
+            int(cube.shape[1] * 0.25) : int(cube.shape[1] * 0.75),
+        ]
+        if counter == 0:
+            porosity_init = np.count_nonzero(cube_to_check_centre == 0)
+        porosity = np.count_nonzero(cube_to_check_centre == 0)
+        counter = counter + 1
+        if porosity <= porosity_init * 0.1:
+            return t_ratio
+        t_ratio = t_ratio - 0.01
+    raise ValueError("No layer overlap ratio makes the stacked layers dense")
+
+
+def search(surface, layer_height, num_layers):
+    return porosity_search(surface, layer_height, num_layers)[0]
+
+
+def outcome(function, *args):
+    # The t_ratio found, or the type of error raised
+    try:
+        return function(*args)
+    except (ValueError, IndexError) as e:
+        return type(e).__name__
+
+
+def melt_pool_mask(width, height, exponent, tilt, lobes=()) -> np.ndarray:
+    # Bead above the substrate (row 60) in a 96x96 prediction: the upper half of
+    # a superellipse, sheared by `tilt`, with elliptic `lobes` (cy, cx, ry, rx)
+    # added like the bumps of the predicted masks
+    y, x = np.mgrid[:96, :96].astype(float)
+    sheared = x - 48 - tilt * (60 - y)
+    mask = (
+        np.abs(sheared / (width / 2)) ** exponent
+        + np.abs((60 - y) / height) ** exponent
+        < 1
+    )
+    for cy, cx, ry, rx in lobes:
+        mask |= ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 < 1
+    return mask & (y <= 60)
+
+
+def synthetic_surfaces(cases, seed):
+    rng = np.random.default_rng(seed)
+    for case in range(cases):
+        lobes = [
+            (rng.uniform(30, 60), rng.uniform(20, 76), *rng.uniform(3, 15, 2))
+            for _ in range(rng.integers(0, 4))
+        ]
+        mask = melt_pool_mask(
+            rng.uniform(20, 80),
+            rng.uniform(8, 40),
+            rng.uniform(1, 4),
+            rng.uniform(-0.5, 0.5),
+            lobes,
+        )
+        angle = rng.uniform(-30, 30)
+        hatch_spacing = rng.uniform(0.2, 1.0)
+        num_tracks = int(rng.choice((1, 5)))
+        yield f"case {case}", mask, angle, hatch_spacing, num_tracks
+
+
+def csv_surfaces(path, num_tracks):
+    data = pd.read_csv(path)
+    power, speed, rpm, hatch_spacing = (
+        data[name].to_numpy(float)
+        for name in ("laser_power", "scanning_speed", "rpm_1", "hatch_spacing")
+    )
+    models.load()
+    _, masks, width, height = mask_stage(
+        power, rpm, speed, models.para2geom, models.para2geom_pca, models.sc
+    )
+    angle = angle_stage(width, speed, hatch_spacing, height, models.hs2angle)
+    for i, idx in enumerate(data["idx"]):
+        yield f"idx {idx}", masks[i], angle[i], hatch_spacing[i], num_tracks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cases", type=int, default=500)
+    parser.add_argument("--csv", help="G.L.O.W. CSV to take the rows from")
+    parser.add_argument("--num-tracks", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--num-layers", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.csv:
+        surfaces = (
+            surface
+            for num_tracks in args.num_tracks
+            for surface in csv_surfaces(args.csv, num_tracks)
+        )
+    else:
+        surfaces = synthetic_surfaces(args.cases, args.seed)
+
+    total = 0
+    mismatches = 0
+    for name, mask, angle, hatch_spacing, num_tracks in surfaces:
+        rotated_aoi_mask, layer_height, rotated_width = rotate_aoi(mask, angle)
+        surface = tile_tracks(
+            rotated_aoi_mask, rotated_width, hatch_spacing, num_tracks
+        )
+        expected = outcome(porosity_loop, surface, layer_height, args.num_layers)
+        total += 1
+        t_ratio = outcome(search, surface, layer_height, args.num_layers)
+        if t_ratio != expected:
+            mismatches += 1
+            print(f"{name} ({num_tracks} tracks): {t_ratio} instead of {expected}")
+    print(f"{mismatches}/{total} surfaces differ from the loop")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
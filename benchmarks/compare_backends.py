@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the NumPy backend of para2geom against Keras and compares their load time
+
+Usage: python benchmarks/compare_backends.py [--samples 1000]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from ml import MODEL_FILES, NumpyModel, load_para2geom, resource_path  # noqa: E402
+
+
+def compare_backends(samples: int = 1000, seed: int = 0) -> dict:
+    """
+    Evaluates para2geom with Keras and with `NumpyModel` on the same random scaled
+    inputs and reports how far apart the outputs and the resulting masks are,
+    along with the difference between `Model.predict` and `CompiledKerasModel`.
+    Requires Keras.
+    """
+    path = resource_path(*MODEL_FILES["para2geom"])
+    keras_model, _ = load_para2geom("keras")
+    numpy_model = NumpyModel.from_h5(path)
+    pca = joblib.load(resource_path(*MODEL_FILES["para2geom_pca"]))
+
+    # Inputs are standard scaled, so this covers well beyond the training range
+    x = np.random.default_rng(seed).uniform(-3, 3, (samples, 3)).astype(np.float32)
+    expected = keras_model.model.predict(x, verbose=0)
+    compiled = keras_model.predict(x)
+    actual = numpy_model.predict(x)
+    # Relative to the output range: float32 sums of large terms cancel near zero
+    difference = np.abs(actual - expected) / np.abs(expected).max()
+    masks_differ = (pca.inverse_transform(actual) > 127) != (
+        pca.inverse_transform(expected) > 127
+    )
+    return {
+        "samples": samples,
+        "max_abs_diff": float(np.abs(actual - expected).max()),
+        "max_rel_diff": float(difference.max()),
+        "allclose": bool(difference.max() < 1e-5),
+        "mask_pixel_diff_rate": float(masks_differ.mean()),
+        "compiled_max_abs_diff": float(np.abs(compiled - expected).max()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    report = compare_backends(args.samples)
+    for name, value in report.items():
+        print(f"{name:>22}: {value}")
+    print()
+
+    for backend in ("keras", "numpy"):
+        start = time.perf_counter()
+        load_para2geom(backend)
+        print(f"{backend:>6} load: {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
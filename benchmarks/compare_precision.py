@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the float32 and int8-weight mask predictions against the default float64
+mode, with their time and peak memory on a large batch
+
+Usage: python benchmarks/compare_precision.py [--samples 10000]
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import joblib
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from ml import MODEL_FILES, Float32PCA, NumpyModel, resource_path  # noqa: E402
+
+
+def compare_precision(samples: int = 10000, seed: int = 0) -> dict:
+    """
+    Evaluates the mask prediction (para2geom with `NumpyModel`, then the PCA
+    reconstruction and the threshold at 127) as each `ModelManager` precision
+    does, and with int8-rounded weights, on the same random scaled inputs. The
+    network runs in float32 in every mode, as in Keras. Reports for each how
+    often the masks differ from the float64 mode (per pixel and per mask), its
+    time and its peak memory.
+    """
+    network = NumpyModel.from_h5(resource_path(*MODEL_FILES["para2geom"]))
+    pca = joblib.load(resource_path(*MODEL_FILES["para2geom_pca"]))
+    paths = {
+        "float64": (network, pca),
+        "float32": (network, Float32PCA(pca)),
+        "int8_weights": (network.quantized(), Float32PCA(pca, quantized=True)),
+    }
+
+    # Inputs are standard scaled, so this covers well beyond the training range
+    x = np.random.default_rng(seed).uniform(-3, 3, (samples, 3))
+    report = {"samples": samples}
+    reference = None
+    for name, (model, reconstruction) in paths.items():
+        start = time.perf_counter()
+        masks = reconstruction.inverse_transform(model.predict(x)) > 127
+        seconds = time.perf_counter() - start
+        # Memory is traced on a second run, tracing slows the first one down
+        tracemalloc.start()
+        reconstruction.inverse_transform(model.predict(x))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if reference is None:
+            reference = masks
+        differ = masks != reference
+        report[f"{name}_mask_pixel_diff_rate"] = float(differ.mean())
+        report[f"{name}_mask_diff_rate"] = float(differ.any(axis=1).mean())
+        report[f"{name}_seconds"] = seconds
+        report[f"{name}_peak_mb"] = peak / 2**20
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for name, value in compare_precision(args.samples, args.seed).items():
+        print(f"{name:>33}: {value}")
+
+
+if __name__ == "__main__":
+    main()
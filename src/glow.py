@@ -11,7 +11,14 @@ import sys
 import pandas as pd
 from pathlib import Path
 
-from PyQt6.QtCore import Qt, QSettings, QUrl, QStandardPaths, QCoreApplication
+from PyQt6.QtCore import (
+    Qt,
+    QSettings,
+    QUrl,
+    QStandardPaths,
+    QCoreApplication,
+    QTimer,
+)
 from PyQt6.QtGui import QDragEnterEvent, QDropEvent, QMouseEvent, QColor, QIcon, QPixmap
 from PyQt6.QtWidgets import (
     QApplication,
@@ -43,7 +50,19 @@ import matplotlib.patches as patches
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 
-from ml import meltpool_geom_cal
+from ml import (
+    ModelManager,
+    dedup_stats,
+    meltpool_geom_cal_resumable,
+    memory_summary,
+    model_hash,
+    models,
+    profiler,
+    release_memory,
+    reset_peak_memory,
+)
+from ml_cache import PredictionCache, PredictionCheckpoint
+from ml_server import use_server
 
 
 def resource_path(*relative_path: str) -> str:
@@ -157,6 +176,8 @@ class GLOWgui(QWidget):
         "main_layout",
         "margin_c",
         "margin_r",
+        "ml_cache",
+        "mlw_input",
         "mscode",
         "nc_viewer",
         "nps_input",
@@ -423,6 +444,7 @@ class GLOWgui(QWidget):
         self.settings = QSettings(
             str(appdata / "machine settings.ini"), QSettings.Format.IniFormat
         )
+        self.ml_cache = PredictionCache(appdata / "ml_cache.sqlite", model_hash())
 
         title2 = QLabel("Machine Settings")
         title2.setStyleSheet(
@@ -493,6 +515,15 @@ class GLOWgui(QWidget):
         wt_layout.addStretch(2)
         column_1.addLayout(wt_layout, 1)
 
+        mlw_layout = QHBoxLayout()
+        mlw_label = QLabel("ML worker processes: ")
+        mlw_layout.addWidget(mlw_label, 1)
+        self.mlw_input = QLineEdit()
+        self.mlw_input.setText(self.settings.value("ml_workers", "1"))
+        mlw_layout.addWidget(self.mlw_input, 1)
+        mlw_layout.addStretch(3)
+        column_1.addLayout(mlw_layout, 1)
+
         print_setting.addLayout(column_1, 1)
 
         column_2 = QVBoxLayout()
@@ -1245,26 +1276,61 @@ class GLOWgui(QWidget):
             ml_lh = self.use_ml_lh.isChecked() and shape != "Single Track"
 
             if ml_w or ml_h or ml_lh:
+                if models.state != ModelManager.READY and models.remote is None:
+                    self.display.addItem("Waiting for ML models to load...")
+                    self.display.scrollToBottom()
+                    QApplication.processEvents()
+
                 self.display.addItem("Using machine learning model...")
-                width_data = []
-                height_data = []
-                layer_height_data = []
-                for row in csv_data.itertuples():
-                    w, h, lh = meltpool_geom_cal(
-                        power=row.laser_power,
-                        speed=row.scanning_speed,
-                        rpm=row.rpm_1 + row.rpm_2,
-                        hatch_spacing=row.hatch_spacing,
-                        rotate=True, # shape == "Cube" (if False -> porosity diverges)
-                        num_tracks=5 if shape == "Cube" else 1,
-                        num_layers=3,
+                self.ml_cache.reset_stats()
+                dedup_stats.reset()
+                reset_peak_memory()
+                profiler.reset()
+                profiler.enable()
+                ml_settings = {
+                    "rotate": True,  # shape == "Cube" (if False -> porosity diverges)
+                    "num_tracks": 5 if shape == "Cube" else 1,
+                    "num_layers": 3,
+                }
+                # Predictions are saved next to the CSV as they are computed, so an
+                # interrupted run resumes from the last completed rows
+                checkpoint = PredictionCheckpoint(
+                    self.filedrop.file_path.parent
+                    / (self.filedrop.file_path.stem + "_ML_checkpoint.csv"),
+                    {**ml_settings, "model_hash": model_hash()},
+                )
+                try:
+                    width_data, height_data, layer_height_data = (
+                        meltpool_geom_cal_resumable(
+                            power=csv_data["laser_power"].to_numpy(),
+                            speed=csv_data["scanning_speed"].to_numpy(),
+                            rpm=(csv_data["rpm_1"] + csv_data["rpm_2"]).to_numpy(),
+                            hatch_spacing=csv_data["hatch_spacing"].to_numpy(),
+                            checkpoint=checkpoint,
+                            cache=self.ml_cache,
+                            workers=int(self.mlw_input.text()),
+                            **ml_settings,
+                        )
+                    )
+                except Exception as e:
+                    error = QListWidgetItem(f"Error: ML model prediction failed: {e}")
+                    error.setForeground(QColor("#ff0000"))
+                    self.display.addItem(error)
+                    self.display.scrollToBottom()
+                    return None
+                finally:
+                    profiler.disable()
+                    release_memory()
+                self.display.addItem(
+                    f"ML cache: {self.ml_cache.hits} hits, {self.ml_cache.misses} misses"
+                )
+                self.display.addItem(dedup_stats.summary())
+                if checkpoint.resumed:
+                    self.display.addItem(
+                        f"ML checkpoint: resumed {checkpoint.resumed} rows"
                     )
-                    if ml_w:
-                        width_data.append(w)
-                    if ml_h:
-                        height_data.append(h)
-                    if ml_lh:
-                        layer_height_data.append(lh)
+                self.display.addItem(profiler.summary())
+                self.display.addItem(memory_summary())
 
                 if ml_w:
                     csv_data["width"] = width_data
@@ -1282,6 +1348,7 @@ class GLOWgui(QWidget):
                     final_path = csv_path.parent / (str(csv_path.stem) + f" ({i}).csv")
                     i += 1
                 csv_data.to_csv(final_path, index=False)
+                checkpoint.remove()
 
             self.positions.sort(key=lambda pos: (pos[1], pos[0]))
 
@@ -1764,6 +1831,7 @@ class GLOWgui(QWidget):
         # self.lsp_input.setText(self.settings.value("laser_power", "1000"))
         self.gfr_input.setText(self.settings.value("gas_flow_rate", "2.5"))
         self.wt_input.setText(self.settings.value("waiting_time", "30"))
+        self.mlw_input.setText(self.settings.value("ml_workers", "1"))
         self.cdt_input.setText(self.settings.value("cooldown_intertracks", "0"))
         self.cdl_input.setText(self.settings.value("cooldown_interlayers", "0"))
         self.cdo_input.setText(self.settings.value("cooldown_interobjects", "0"))
@@ -1806,6 +1874,7 @@ class GLOWgui(QWidget):
         # self.settings.setValue("laser_power", self.lsp_input.text())
         self.settings.setValue("gas_flow_rate", self.gfr_input.text())
         self.settings.setValue("waiting_time", self.wt_input.text())
+        self.settings.setValue("ml_workers", self.mlw_input.text())
         self.settings.setValue("cooldown_intertracks", self.cdt_input.text())
         self.settings.setValue("cooldown_interlayers", self.cdl_input.text())
         self.settings.setValue("cooldown_interobjects", self.cdo_input.text())
@@ -1907,4 +1976,8 @@ def gui():
     )
     window = MainWindow(app)
     window.show()
+    # Use a running ML server, or load the ML models in the background once the
+    # window is up
+    if not use_server():
+        QTimer.singleShot(0, models.load_async)
     sys.exit(app.exec())
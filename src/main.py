@@ -1,7 +1,11 @@
+import multiprocessing
+
 from glow import gui
 
 def main():
     gui()
 
 if __name__ == "__main__":
+    # Needed by the ML worker processes in the frozen (PyInstaller) executable
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
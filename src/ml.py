@@ -5,11 +5,22 @@ Adapted from the original project on xshang93/AIDED
 """
 
 import cv2
+import ctypes
+import gc
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
 import warnings
+import weakref
 import joblib
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count, repeat
 from pathlib import Path
-from keras.models import load_model
 
 # Suppress all UserWarning warnings
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -17,15 +28,440 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 
 ## ---------------------- Load the trained ML models ------------------------ #
-def resource_path(relative_path: str) -> str:
+def resource_path(*relative_path: str) -> str:
     base_path = Path(__file__).resolve().parent.parent
-    return str((Path(base_path) / relative_path).resolve())
+    for path in relative_path:
+        base_path = base_path / path
+    return str(base_path.resolve())
 
 
-para2geom = load_model(resource_path("assets\\ML_models\\para2geom.h5"), compile=False)
-para2geom_pca = joblib.load(resource_path("assets\\ML_models\\pca_transformer.pkl"))
-sc = joblib.load(resource_path("assets\\ML_models\\sc.bin"))
-hs2angle = joblib.load(resource_path("assets\\ML_models\\hs2angle.pkl"))
+MODEL_FILES = {
+    "para2geom": ("assets", "ML_models", "para2geom.h5"),
+    "para2geom_pca": ("assets", "ML_models", "pca_transformer.pkl"),
+    "sc": ("assets", "ML_models", "sc.bin"),
+    "hs2angle": ("assets", "ML_models", "hs2angle.pkl"),
+}
+
+
+class ModelManager:
+    """
+    Loads the trained models on first use (or in a background thread via
+    `load_async`) so that importing this module does not pull in TensorFlow.
+
+    `backend` selects how para2geom is evaluated: "keras", "numpy" (see
+    `NumpyModel`) or "auto", which uses Keras when it can be imported and NumPy
+    otherwise. The default comes from the GLOW_ML_BACKEND environment variable.
+    The thread limits of `set_thread_limits` are applied when loading.
+
+    `precision` selects how the PCA reconstruction of the masks is computed:
+    "float64" (scikit-learn) or "float32" (see `Float32PCA`), set by default
+    from the GLOW_ML_PRECISION environment variable.
+
+    With `use_remote`, batches are sent to an ML server (see ml_server.py) that
+    keeps the models loaded in its own process; they are only loaded here if the
+    server stops answering.
+    """
+
+    NOT_LOADED = "not loaded"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+    BACKENDS = ("auto", "keras", "numpy")
+    PRECISIONS = ("float64", "float32")
+
+    def __init__(self, backend=None) -> None:
+        self._lock = threading.Lock()
+        self._thread = None
+        self.state = ModelManager.NOT_LOADED
+        self.error = None
+        self.backend = None
+        self.precision = None
+        self.active_backend = None
+        self.para2geom = None
+        self.para2geom_pca = None
+        self.sc = None
+        self.hs2angle = None
+        self.remote = None
+        self.set_backend(backend or os.environ.get("GLOW_ML_BACKEND", "auto"))
+        self.set_precision(os.environ.get("GLOW_ML_PRECISION", "float64"))
+
+    def set_backend(self, backend: str) -> None:
+        # The network is loaded again with the new backend on the next load()
+        if backend not in ModelManager.BACKENDS:
+            raise ValueError(
+                f"Unknown ML backend {backend!r}, expected one of {ModelManager.BACKENDS}"
+            )
+        with self._lock:
+            if backend != self.backend:
+                self.backend = backend
+                self.active_backend = None
+                self.para2geom = None
+                if self.state != ModelManager.LOADING:
+                    self.state = ModelManager.NOT_LOADED
+
+    def set_precision(self, precision: str) -> None:
+        # The PCA is loaded again with the new precision on the next load()
+        if precision not in ModelManager.PRECISIONS:
+            raise ValueError(
+                f"Unknown ML precision {precision!r}, expected one of "
+                f"{ModelManager.PRECISIONS}"
+            )
+        with self._lock:
+            if precision != self.precision:
+                self.precision = precision
+                self.para2geom_pca = None
+                if self.state != ModelManager.LOADING:
+                    self.state = ModelManager.NOT_LOADED
+
+    def use_remote(self, client) -> None:
+        # `client` is an ml_server.MLServerClient, or None to evaluate here
+        self.remote = client
+
+    def load(self) -> "ModelManager":
+        # Blocks until the models are ready; waits for a background load in progress
+        with self._lock:
+            if self.state == ModelManager.READY:
+                return self
+            self.state = ModelManager.LOADING
+            self.error = None
+            try:
+                apply_thread_limits()
+                self.para2geom, self.active_backend = load_para2geom(self.backend)
+                self.para2geom_pca = joblib.load(
+                    resource_path(*MODEL_FILES["para2geom_pca"])
+                )
+                if self.precision == "float32":
+                    self.para2geom_pca = Float32PCA(self.para2geom_pca)
+                self.sc = joblib.load(resource_path(*MODEL_FILES["sc"]))
+                self.hs2angle = joblib.load(resource_path(*MODEL_FILES["hs2angle"]))
+            except Exception as e:
+                self.state = ModelManager.FAILED
+                self.error = e
+                raise
+            # Results memoized with the previous models are never looked up again
+            clear_stage_caches()
+            self.state = ModelManager.READY
+        return self
+
+    def load_async(self) -> None:
+        if self.state != ModelManager.NOT_LOADED or self._thread is not None:
+            return
+        # Mark as loading right away so callers polling the state see it
+        self.state = ModelManager.LOADING
+        self._thread = threading.Thread(target=self._load_quietly, daemon=True)
+        self._thread.start()
+
+    def _load_quietly(self) -> None:
+        try:
+            self.load()
+        except Exception:
+            # Kept in self.error, raised again by the next blocking load()
+            pass
+
+    def wait(self, timeout=None) -> bool:
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.state == ModelManager.READY
+
+
+def load_para2geom(backend="auto") -> tuple:
+    # Returns the network and the backend actually used to load it
+    path = resource_path(*MODEL_FILES["para2geom"])
+    if backend != "numpy":
+        try:
+            from keras.models import load_model
+        except ImportError:
+            if backend == "keras":
+                raise
+        else:
+            _limit_tensorflow_threads(thread_limits["tensorflow"])
+            return CompiledKerasModel(load_model(path, compile=False)), "keras"
+    return NumpyModel.from_h5(path), "numpy"
+
+
+class CompiledKerasModel:
+    """
+    Keras model called through a `tf.function` with a fixed (None, n_inputs)
+    float32 signature, traced once when created. Small batches then skip the
+    per-call overhead of `Model.predict` (data adapters, callbacks, retracing).
+    """
+
+    def __init__(self, model) -> None:
+        import tensorflow as tf
+
+        self.model = model
+        self.n_inputs = model.input_shape[-1]
+        self._call = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec((None, self.n_inputs), tf.float32)],
+        )
+        # Warm-up: the trace and the first kernel launches happen here
+        self.predict(np.zeros((1, self.n_inputs), dtype=np.float32))
+
+    def predict(self, x, verbose=0):
+        # Same call as keras' Model.predict; `verbose` is accepted and ignored
+        return self._call(np.asarray(x, dtype=np.float32)).numpy()
+
+
+class NumpyModel:
+    """
+    Forward pass of a Keras Sequential model made of Dense layers, with the weights
+    read from its .h5 file and evaluated as NumPy matrix products. Provides the
+    `predict` method used by this module, so it replaces the Keras model without
+    needing TensorFlow.
+    """
+
+    ACTIVATIONS = {
+        "linear": lambda x: x,
+        "relu": lambda x: np.maximum(x, 0, out=x),
+        "tanh": lambda x: np.tanh(x, out=x),
+        "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    }
+
+    def __init__(self, layers: list, dtype=np.float32) -> None:
+        # One (kernel, bias or None, activation name) per Dense layer
+        self.dtype = np.dtype(dtype)
+        self.layers = [
+            (
+                np.asarray(kernel, dtype=self.dtype),
+                None if bias is None else np.asarray(bias, dtype=self.dtype),
+                activation,
+            )
+            for kernel, bias, activation in layers
+        ]
+
+    def quantized(self) -> "NumpyModel":
+        # Same network with its kernels rounded to int8 levels (see `quantize`)
+        return NumpyModel(
+            [
+                (quantize(kernel), bias, activation)
+                for kernel, bias, activation in self.layers
+            ],
+            self.dtype,
+        )
+
+    @classmethod
+    def from_h5(cls, path) -> "NumpyModel":
+        import h5py
+
+        layers = []
+        with h5py.File(path, "r") as file:
+            config = json.loads(file.attrs["model_config"])
+            for layer in config["config"]["layers"]:
+                if layer["class_name"] == "InputLayer":
+                    continue
+                if layer["class_name"] != "Dense":
+                    raise ValueError(f"Unsupported layer type: {layer['class_name']}")
+                name = layer["config"]["name"]
+                activation = layer["config"]["activation"]
+                if activation not in cls.ACTIVATIONS:
+                    raise ValueError(f"Unsupported activation: {activation}")
+                group = file["model_weights"][name]
+                weights = {}
+                for weight_name in group.attrs["weight_names"]:
+                    if isinstance(weight_name, bytes):
+                        weight_name = weight_name.decode()
+                    # e.g. "dense/kernel:0" -> "kernel"
+                    weights[weight_name.split("/")[-1].split(":")[0]] = group[
+                        weight_name
+                    ][()]
+                layers.append((weights["kernel"], weights.get("bias"), activation))
+        return cls(layers)
+
+    def predict(self, x, verbose=0):
+        # Same call as keras' Model.predict; `verbose` is accepted and ignored
+        x = np.asarray(x, dtype=self.dtype)
+        for kernel, bias, activation in self.layers:
+            x = x @ kernel
+            if bias is not None:
+                x += bias
+            x = self.ACTIVATIONS[activation](x)
+        return x
+
+
+class Float32PCA:
+    """
+    `inverse_transform` of a fitted scikit-learn PCA computed in float32, with
+    the whitening folded into the components. The reconstruction is the largest
+    array of the mask prediction (96 x 96 values per row), so this halves its
+    memory and time on large batches; benchmarks/compare_precision.py reports how
+    often the thresholded masks change.
+    """
+
+    def __init__(self, pca, quantized=False) -> None:
+        components = np.asarray(pca.components_, dtype=float)
+        if getattr(pca, "whiten", False):
+            components = components * np.sqrt(pca.explained_variance_)[:, None]
+        if quantized:
+            components = quantize(components.T).T
+        self.components = components.astype(np.float32)
+        self.mean = np.asarray(pca.mean_, dtype=np.float32)
+
+    def inverse_transform(self, x):
+        reconstruction = np.asarray(x, dtype=np.float32) @ self.components
+        reconstruction += self.mean
+        return reconstruction
+
+
+def quantize(weights):
+    # Rounds every column to 255 symmetric int8 levels and scales it back
+    scale = np.abs(weights).max(axis=0) / 127
+    scale[scale == 0] = 1
+    return np.round(weights / scale).clip(-127, 127) * scale
+
+
+models = ModelManager()
+
+
+def model_hash() -> str:
+    # Fingerprint of the model files, used to invalidate cached predictions
+    digest = hashlib.sha256()
+    for parts in MODEL_FILES.values():
+        path = Path(resource_path(*parts))
+        digest.update(path.name.encode())
+        if path.exists():
+            digest.update(path.read_bytes())
+    if models.precision != "float64":
+        # Reduced precision predictions are not interchangeable with float64 ones
+        digest.update(models.precision.encode())
+    return digest.hexdigest()
+
+
+## ----------------------- Thread and memory limits ------------------------- #
+# Threads each library may use, None for its own default (usually one per core).
+# GLOW_ML_THREADS sets the same limit for all of them.
+thread_limits = dict.fromkeys(("tensorflow", "blas", "opencv"), None)
+if os.environ.get("GLOW_ML_THREADS"):
+    thread_limits.update(
+        dict.fromkeys(thread_limits, int(os.environ["GLOW_ML_THREADS"]))
+    )
+_blas_limiter = None
+
+
+def set_thread_limits(tensorflow=None, blas=None, opencv=None) -> None:
+    """
+    Limits the threads of TensorFlow (intra- and inter-op pools), of the BLAS
+    used by NumPy and scikit-learn, and of OpenCV. BLAS and OpenCV limits apply
+    right away; TensorFlow only accepts them before it first runs, so they are
+    applied when the models are loaded.
+    """
+    for library, threads in zip(thread_limits, (tensorflow, blas, opencv)):
+        if threads is not None:
+            thread_limits[library] = int(threads)
+    apply_thread_limits()
+
+
+def apply_thread_limits() -> None:
+    global _blas_limiter
+    if thread_limits["opencv"] is not None:
+        cv2.setNumThreads(thread_limits["opencv"])
+    if thread_limits["blas"] is not None:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            # Only installed along with scikit-learn; BLAS keeps its default
+            pass
+        else:
+            _blas_limiter = threadpool_limits(thread_limits["blas"], user_api="blas")
+    if "tensorflow" in sys.modules:
+        _limit_tensorflow_threads(thread_limits["tensorflow"])
+
+
+def _limit_tensorflow_threads(threads) -> None:
+    if threads is None:
+        return
+    import tensorflow as tf
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError:
+        # TensorFlow already ran and keeps the pools it started with
+        pass
+
+
+def release_memory() -> None:
+    """
+    Frees the memory held after a batch: the scratch buffers and unreachable
+    objects, then hands the freed heap back to the OS where the C library allows
+    it. The stage caches are kept (they are bounded), so the next generation or
+    server request still reuses them.
+    """
+    scratch.clear()
+    gc.collect()
+    if sys.platform.startswith("linux"):
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            # Not glibc
+            pass
+
+
+def reset_peak_memory() -> bool:
+    # Restarts the peak RSS count where the OS allows it (Linux); returns whether it did
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def memory_usage() -> tuple:
+    """
+    Current and peak resident memory (RSS) of this process, in bytes. The peak
+    is counted from the last `reset_peak_memory` on Linux and from the start of
+    the process elsewhere; worker processes are not included.
+    """
+    if sys.platform == "win32":
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters),
+            counters.cb,
+        )
+        return counters.WorkingSetSize, counters.PeakWorkingSetSize
+    try:
+        with open("/proc/self/status") as file:
+            status = dict(line.split(":", 1) for line in file)
+        return (
+            int(status["VmRSS"].split()[0]) * 1024,
+            int(status["VmHWM"].split()[0]) * 1024,
+        )
+    except (OSError, KeyError, ValueError):
+        import resource
+
+        # ru_maxrss is in bytes on macOS; the current RSS is not available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+
+
+def memory_summary() -> str:
+    current, peak = memory_usage()
+    return f"ML memory: peak RSS {peak / 2**20:.0f} MB, {current / 2**20:.0f} MB now"
+
+
+# length of mm for 1 pix for a 1280x960 image. Measured on 20240607 using /home/xiao/projects/DED/BO_processing/images/20240418_singletrack_data_retake/scale_bar_67um_mp10&11.jpg
+scale_measured = 0.0038
+resize_dim = (96, 96)  # original size (550,550), cropped to (96,96)
+scale = scale_measured / resize_dim[1] * 550
 
 
 def meltpool_geom_cal(
@@ -36,202 +472,1046 @@ def meltpool_geom_cal(
     rotate=True,
     num_tracks=10,
     num_layers=3,
-    para2geom=para2geom,
-    para2geom_pca=para2geom_pca,
-    sc=sc,
-    hs2angle=hs2angle,
+    para2geom=None,
+    para2geom_pca=None,
+    sc=None,
+    hs2angle=None,
+    t_tol=0.01,
+    t_max_steps=None,
+    return_iterations=False,
+):
+    results = meltpool_geom_cal_batch(
+        [power],
+        [speed],
+        [rpm],
+        [hatch_spacing],
+        rotate=rotate,
+        num_tracks=num_tracks,
+        num_layers=num_layers,
+        para2geom=para2geom,
+        para2geom_pca=para2geom_pca,
+        sc=sc,
+        hs2angle=hs2angle,
+        t_tol=t_tol,
+        t_max_steps=t_max_steps,
+        return_iterations=return_iterations,
+    )
+    return tuple(result[0] for result in results)
+
+
+def meltpool_geom_cal_batch(
+    power,
+    speed,
+    rpm,
+    hatch_spacing,
+    rotate=True,
+    num_tracks=10,
+    num_layers=3,
+    para2geom=None,
+    para2geom_pca=None,
+    sc=None,
+    hs2angle=None,
+    cache=None,
+    t_tol=0.01,
+    t_max_steps=None,
+    return_iterations=False,
+    workers=1,
+):
+    """
+    Vectorized version of `meltpool_geom_cal` for arrays of process parameters.
+
+    Each model is called once for the whole batch; only the rotation, tiling and
+    porosity stages run per row. Returns arrays of width, layer height and t_ratio.
+    If a `PredictionCache` is given, only the rows missing from it are evaluated.
+
+    `t_tol` and `t_max_steps` are the step and the step limit of the t_ratio
+    search (see `porosity_search`). With `return_iterations=True` the number of
+    stacked layer compositions evaluated for each row is returned as a fourth
+    array.
+
+    With `workers > 1` the per-row stages are spread over a pool of processes
+    (see `process_pool`); results keep the order of the inputs.
+
+    Rows repeating the same process point are evaluated once and share the result
+    (their iteration count is 0); `dedup_stats` keeps the number of rows and
+    distinct points.
+    """
+    power, speed, rpm, hatch_spacing = np.broadcast_arrays(
+        *(
+            np.atleast_1d(np.asarray(v, dtype=float))
+            for v in (power, speed, rpm, hatch_spacing)
+        )
+    )
+    start = time.perf_counter()
+    points, first, inverse = np.unique(
+        np.column_stack((power, speed, rpm, hatch_spacing)),
+        axis=0,
+        return_index=True,
+        return_inverse=True,
+    )
+    *results, iterations = _cal_batch(
+        *points.T,
+        rotate,
+        num_tracks,
+        num_layers,
+        para2geom,
+        para2geom_pca,
+        sc,
+        hs2angle,
+        cache,
+        t_tol,
+        t_max_steps,
+        workers,
+    )
+    dedup_stats.record(len(power), len(points), time.perf_counter() - start)
+
+    inverse = inverse.reshape(-1)
+    results = [np.asarray(result)[inverse] for result in results]
+    if return_iterations:
+        row_iterations = np.zeros(len(power), dtype=int)
+        row_iterations[first] = iterations
+        return (*results, row_iterations)
+    return tuple(results)
+
+
+def _cal_batch(
+    power,
+    speed,
+    rpm,
+    hatch_spacing,
+    rotate,
+    num_tracks,
+    num_layers,
+    para2geom,
+    para2geom_pca,
+    sc,
+    hs2angle,
+    cache,
+    t_tol,
+    t_max_steps,
+    workers,
+):
+    # `meltpool_geom_cal_batch` for distinct process points, with iterations
+    if cache is not None:
+        keys = [
+            cache.key(p, s, r, h, rotate, num_tracks, num_layers, t_tol, t_max_steps)
+            for p, s, r, h in zip(power, speed, rpm, hatch_spacing)
+        ]
+        timing = profiler.enabled
+        if timing:
+            start = time.perf_counter()
+        cached = cache.get_many(keys)
+        if timing:
+            profiler.record("cache", start)
+        missing = [i for i, value in enumerate(cached) if value is None]
+        iterations = np.zeros(len(keys), dtype=int)
+        if missing:
+            *computed, iterations[missing] = _cal_batch(
+                power[missing],
+                speed[missing],
+                rpm[missing],
+                hatch_spacing[missing],
+                rotate,
+                num_tracks,
+                num_layers,
+                para2geom,
+                para2geom_pca,
+                sc,
+                hs2angle,
+                None,
+                t_tol,
+                t_max_steps,
+                workers,
+            )
+            computed = list(zip(*computed))
+            if timing:
+                start = time.perf_counter()
+            cache.put_many([keys[i] for i in missing], computed)
+            if timing:
+                profiler.record("cache", start)
+            for i, value in zip(missing, computed):
+                cached[i] = value
+        width, layer_height, t_ratio = (np.array(v, dtype=float) for v in zip(*cached))
+        return width, layer_height, t_ratio, iterations
+
+    if all(model is None for model in (para2geom, para2geom_pca, sc, hs2angle)):
+        result = _on_server(
+            "meltpool_geom_cal_batch",
+            power,
+            speed,
+            rpm,
+            hatch_spacing,
+            rotate=rotate,
+            num_tracks=num_tracks,
+            num_layers=num_layers,
+            t_tol=t_tol,
+            t_max_steps=t_max_steps,
+            return_iterations=True,
+            workers=workers,
+        )
+        if result is not None:
+            return result
+    para2geom, para2geom_pca, sc, hs2angle = _resolve_models(
+        para2geom, para2geom_pca, sc, hs2angle
+    )
+    keys, mp_true, width, height = mask_stage(
+        power, rpm, speed, para2geom, para2geom_pca, sc
+    )
+    return _row_stages(
+        keys,
+        mp_true,
+        width,
+        height,
+        speed,
+        hatch_spacing,
+        hs2angle,
+        rotate,
+        num_tracks,
+        num_layers,
+        t_tol,
+        t_max_steps,
+        True,
+        workers,
+    )
+
+
+def meltpool_geom_sweep(
+    power,
+    speed,
+    rpm,
+    hatch_spacing,
+    rotate=True,
+    num_tracks=10,
+    num_layers=3,
+    para2geom=None,
+    para2geom_pca=None,
+    sc=None,
+    hs2angle=None,
+    t_tol=0.01,
+    t_max_steps=None,
+    return_iterations=False,
+    workers=1,
+):
+    """
+    `meltpool_geom_cal_batch` for one process point and an array of hatch
+    spacings.
+
+    The melt pool mask is predicted once and shared by every spacing; only the
+    hs2angle prediction (one call for all spacings) and the rotation, tiling and
+    porosity stages run per spacing. Returns arrays of width, layer height and
+    t_ratio in the order of `hatch_spacing`.
+    """
+    hatch_spacing = np.atleast_1d(np.asarray(hatch_spacing, dtype=float))
+    n = len(hatch_spacing)
+    if all(model is None for model in (para2geom, para2geom_pca, sc, hs2angle)):
+        result = _on_server(
+            "meltpool_geom_sweep",
+            power,
+            speed,
+            rpm,
+            hatch_spacing,
+            rotate=rotate,
+            num_tracks=num_tracks,
+            num_layers=num_layers,
+            t_tol=t_tol,
+            t_max_steps=t_max_steps,
+            return_iterations=return_iterations,
+            workers=workers,
+        )
+        if result is not None:
+            return result
+    para2geom, para2geom_pca, sc, hs2angle = _resolve_models(
+        para2geom, para2geom_pca, sc, hs2angle
+    )
+    keys, mp_true, width, height = mask_stage(
+        np.array([power], dtype=float),
+        np.array([rpm], dtype=float),
+        np.array([speed], dtype=float),
+        para2geom,
+        para2geom_pca,
+        sc,
+    )
+    return _row_stages(
+        keys * n,
+        mp_true * n,
+        np.repeat(width, n),
+        np.repeat(height, n),
+        np.full(n, float(speed)),
+        hatch_spacing,
+        hs2angle,
+        rotate,
+        num_tracks,
+        num_layers,
+        t_tol,
+        t_max_steps,
+        return_iterations,
+        workers,
+    )
+
+
+def meltpool_geom_cal_resumable(
+    power,
+    speed,
+    rpm,
+    hatch_spacing,
+    checkpoint,
+    chunk_size=256,
+    progress=None,
+    **kwargs,
+):
+    """
+    `meltpool_geom_cal_batch` in chunks of `chunk_size` distinct process points,
+    each written to a `PredictionCheckpoint` (for every row with one of those
+    points) as soon as it is computed. Rows already in the checkpoint are not
+    evaluated again, so an interrupted run resumes where it stopped.
+    `progress(done, total)` is called after every chunk with the number of rows
+    and `kwargs` go to `meltpool_geom_cal_batch`.
+    """
+    power, speed, rpm, hatch_spacing = np.broadcast_arrays(
+        *(
+            np.atleast_1d(np.asarray(v, dtype=float))
+            for v in (power, speed, rpm, hatch_spacing)
+        )
+    )
+    results = np.full((3, len(power)), np.nan)
+    completed = checkpoint.load(power, speed, rpm, hatch_spacing)
+    for row, values in completed.items():
+        results[:, row] = values
+
+    remaining = np.array(
+        [row for row in range(len(power)) if row not in completed], dtype=int
+    )
+    # Repeated points are removed over the whole CSV rather than in each chunk,
+    # where most repeats would fall in different chunks
+    points, inverse = np.unique(
+        np.column_stack((power, speed, rpm, hatch_spacing))[remaining],
+        axis=0,
+        return_inverse=True,
+    )
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    done = len(completed)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start : start + chunk_size]
+        values = meltpool_geom_cal_batch(*chunk.T, **kwargs)
+        # Rows whose point is in the chunk, and the position of their point
+        low, high = np.searchsorted(inverse[order], (start, start + len(chunk)))
+        rows = remaining[order[low:high]]
+        row_values = np.array(values[:3])[:, inverse[order[low:high]] - start]
+        results[:, rows] = row_values
+        # The batch only saw the distinct points, the other rows share them
+        dedup_stats.record(len(rows) - len(chunk), 0, 0.0)
+        checkpoint.append(
+            rows,
+            power[rows],
+            speed[rows],
+            rpm[rows],
+            hatch_spacing[rows],
+            zip(*row_values),
+        )
+        done += len(rows)
+        if progress is not None:
+            progress(done, len(power))
+    return tuple(results)
+
+
+def _on_server(function: str, *args, **kwargs):
+    # Result of `function` evaluated by the ML server, or None when there is none;
+    # a server that stopped answering is not used again
+    client = models.remote
+    if client is None:
+        return None
+    try:
+        return client.call(function, *args, **kwargs)
+    except (OSError, EOFError):
+        models.use_remote(None)
+        return None
+
+
+def _resolve_models(para2geom, para2geom_pca, sc, hs2angle) -> tuple:
+    # Models that are not given explicitly come from the shared ModelManager
+    if para2geom is None or para2geom_pca is None or sc is None or hs2angle is None:
+        models.load()
+        para2geom = models.para2geom if para2geom is None else para2geom
+        para2geom_pca = models.para2geom_pca if para2geom_pca is None else para2geom_pca
+        sc = models.sc if sc is None else sc
+        hs2angle = models.hs2angle if hs2angle is None else hs2angle
+    return para2geom, para2geom_pca, sc, hs2angle
+
+
+def _row_stages(
+    keys,
+    mp_true,
+    width,
+    height,
+    speed,
+    hatch_spacing,
+    hs2angle,
+    rotate,
+    num_tracks,
+    num_layers,
+    t_tol,
+    t_max_steps,
+    return_iterations,
+    workers,
+):
+    # Angle prediction for all rows, then the per-row geometry stages
+    if rotate:
+        angle = angle_stage(width, speed, hatch_spacing, height, hs2angle)
+    else:
+        angle = np.zeros(len(mp_true))
+
+    stage_args = (
+        keys,
+        mp_true,
+        angle,
+        hatch_spacing,
+        repeat(num_tracks),
+        repeat(num_layers),
+        repeat(t_tol),
+        repeat(t_max_steps),
+    )
+    if workers > 1 and len(mp_true) > 1:
+        # A few chunks per worker keeps the pool busy without pickling every row
+        chunksize = -(-len(mp_true) // (4 * workers))
+        if profiler.enabled:
+            results = []
+            for result, stats in process_pool(workers).map(
+                _profiled_geometry_stages, *stage_args, chunksize=chunksize
+            ):
+                results.append(result)
+                profiler.merge(stats)
+        else:
+            results = process_pool(workers).map(
+                geometry_stages, *stage_args, chunksize=chunksize
+            )
+    else:
+        results = map(geometry_stages, *stage_args)
+    layer_height, t_ratio, iterations = (
+        np.array(v, dtype=dtype) for v, dtype in zip(zip(*results), (float, float, int))
+    )
+
+    if return_iterations:
+        return width * scale, layer_height * scale, t_ratio, iterations
+    return width * scale, layer_height * scale, t_ratio
+
+
+class DedupStats:
+    """
+    Rows given to `meltpool_geom_cal_batch` and distinct process points among
+    them. `saved_seconds` estimates the time the repeated rows would have taken
+    at the average cost of a distinct point.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.rows = 0
+        self.unique = 0
+        self.seconds = 0.0
+
+    def record(self, rows: int, unique: int, seconds: float) -> None:
+        self.rows += rows
+        self.unique += unique
+        self.seconds += seconds
+
+    @property
+    def ratio(self) -> float:
+        return self.rows / self.unique if self.unique else 1.0
+
+    @property
+    def saved_seconds(self) -> float:
+        if not self.unique:
+            return 0.0
+        return self.seconds / self.unique * (self.rows - self.unique)
+
+    def summary(self) -> str:
+        return (
+            f"ML dedup: {self.rows} rows, {self.unique} distinct "
+            f"({self.ratio:.1f}x), about {self.saved_seconds:.2f} s saved"
+        )
+
+
+dedup_stats = DedupStats()
+
+
+## ------------------------- Parallel row evaluation ------------------------ #
+_pool = None
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool used by `meltpool_geom_cal_batch` for `workers > 1`.
+
+    The pool is kept between batches so that workers start (and import this module)
+    only once, and their stage caches stay warm. The models are evaluated in the
+    calling process for the whole batch, so workers never load them.
+    """
+    global _pool
+    if _pool is None or _pool._max_workers != workers:
+        shutdown_process_pool()
+        _pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    return _pool
+
+
+def shutdown_process_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def _init_worker() -> None:
+    # Rows are already spread over processes, one OpenCV thread each is enough
+    cv2.setNumThreads(1)
+
+
+def _profiled_geometry_stages(*args):
+    # Profiles a row in a worker process and sends the statistics back with it
+    profiler.reset()
+    profiler.enable()
+    return geometry_stages(*args), profiler.stats
+
+
+## --------------------------- Stage profiling ------------------------------ #
+class StageProfiler:
+    """
+    Wall time, number of calls and porosity search iterations of each pipeline
+    stage. Disabled by default, when the stages only test `enabled`.
+
+    Only stages that actually run are counted: memoized or cached results are not.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.stats = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self.stats = {}
+
+    def record(self, stage: str, start: float, iterations: int = 0) -> None:
+        # `start` is the time.perf_counter() value taken when the stage began
+        seconds = time.perf_counter() - start
+        self.merge({stage: {"seconds": seconds, "calls": 1, "iterations": iterations}})
+
+    def merge(self, stats: dict) -> None:
+        for stage, values in stats.items():
+            total = self.stats.setdefault(
+                stage, {"seconds": 0.0, "calls": 0, "iterations": 0}
+            )
+            for name, value in values.items():
+                total[name] += value
+
+    def summary(self) -> str:
+        # One line, slowest stage first
+        parts = []
+        for stage, values in sorted(
+            self.stats.items(), key=lambda item: -item[1]["seconds"]
+        ):
+            part = f"{stage} {values['seconds']:.3f} s ({values['calls']} calls"
+            if values["iterations"]:
+                part += f", {values['iterations']} iterations"
+            parts.append(part + ")")
+        return "ML profile: " + (", ".join(parts) if parts else "no stage ran")
+
+
+profiler = StageProfiler()
+
+
+## ------------------------ Memoized pipeline stages ------------------------ #
+class StageCache:
+    """
+    Small in-memory LRU used to memoize one stage of `meltpool_geom_cal`.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Each stage is keyed only by the inputs it actually depends on:
+#   mask     <- (power, rpm, speed) and the para2geom/PCA/scaler models
+#   angle    <- (width, speed, hatch_spacing, height) and the hs2angle model
+#   rotation <- mask key, angle
+#   tiling   <- rotation key, hatch_spacing, num_tracks
+#   porosity <- tiling key, num_layers
+stage_caches = {
+    "mask": StageCache(512),
+    "angle": StageCache(65536),
+    "rotation": StageCache(2048),
+    "tiling": StageCache(2048),
+    "porosity": StageCache(65536),
+}
+
+
+def clear_stage_caches() -> None:
+    for cache in stage_caches.values():
+        cache.clear()
+
+
+class ScratchPool(threading.local):
+    """
+    Reusable scratch buffers, one set per thread (and so per worker).
+
+    Buffers grow to the largest shape requested and are handed out as zeroed
+    views, so repeated calls and search iterations do not reallocate them.
+    """
+
+    def __init__(self) -> None:
+        self._buffers = {}
+
+    def zeros(self, name: str, shape: tuple, dtype=np.float64):
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[name] = buffer
+        view = buffer[:size].reshape(shape)
+        view.fill(0)
+        return view
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def clear(self) -> None:
+        self._buffers.clear()
+
+
+scratch = ScratchPool()
+
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+# Serial number of every model object seen by the stages. Unlike id(), which is
+# given again to a new object once the old one is freed, a serial is never reused
+_model_serials = weakref.WeakKeyDictionary()
+_next_serial = count()
+
+
+def _model_token(*objects) -> tuple:
+    token = []
+    for obj in objects:
+        try:
+            serial = _model_serials.get(obj)
+            if serial is None:
+                serial = _model_serials[obj] = next(_next_serial)
+        except TypeError:
+            # No weak references to it: the memo key keeps the object alive instead
+            serial = obj
+        token.append(serial)
+    return tuple(token)
+
+
+def mask_stage(power, rpm, speed, para2geom, para2geom_pca, sc):
+    # Runs the network only for the process points that are not memoized yet
+    token = _model_token(para2geom, para2geom_pca, sc)
+    keys = [(float(p), float(r), float(s), token) for p, r, s in zip(power, rpm, speed)]
+    entries = [stage_caches["mask"].get(key) for key in keys]
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    if missing:
+        mp_true = predict_masks(
+            power[missing], rpm[missing], speed[missing], para2geom, para2geom_pca, sc
+        )
+        timing = profiler.enabled
+        if timing:
+            start = time.perf_counter()
+        width, height = mask_extremes(mp_true)
+        if timing:
+            profiler.record("extremes", start)
+        for j, i in enumerate(missing):
+            # A copy, a view would keep the whole batch of masks alive
+            entries[i] = (_frozen(mp_true[j].copy()), width[j], height[j])
+            stage_caches["mask"].put(keys[i], entries[i])
+
+    mp_true = [entry[0] for entry in entries]
+    width = np.array([entry[1] for entry in entries])
+    height = np.array([entry[2] for entry in entries])
+    return keys, mp_true, width, height
+
+
+def angle_stage(width, speed, hatch_spacing, height, hs2angle):
+    # need to resize width and height from 96x96 image back to 550x550 image
+    features = np.column_stack(
+        (width / 96 * 550, speed, hatch_spacing, height / 96 * 550)
+    )
+    token = _model_token(hs2angle)
+    keys = [(*map(float, row), token) for row in features]
+    angle = np.array([stage_caches["angle"].get(key) for key in keys], dtype=float)
+    missing = np.flatnonzero(np.isnan(angle))
+    if len(missing):
+        timing = profiler.enabled
+        if timing:
+            start = time.perf_counter()
+        angle[missing] = hs2angle.predict(features[missing])
+        if timing:
+            profiler.record("hs2angle", start)
+        for i in missing:
+            stage_caches["angle"].put(keys[i], angle[i])
+    return angle
+
+
+def geometry_stages(
+    key,
+    mp_true,
+    angle,
+    hatch_spacing,
+    num_tracks,
+    num_layers,
+    t_tol=0.01,
+    t_max_steps=None,
 ):
-    scale_measured = 0.0038  # length of mm for 1 pix for a 1280x960 image. Measured on 20240607 using /home/xiao/projects/DED/BO_processing/images/20240418_singletrack_data_retake/scale_bar_67um_mp10&11.jpg
-    resize_dim = (96, 96)  # original size (550,550), cropped to (96,96)
-    scale = scale_measured / resize_dim[1] * 550
+    # Rotation, tiling and porosity stages for a single mask, each memoized
+    timing = profiler.enabled
+    rotation_key = (key, float(angle))
+    rotation = stage_caches["rotation"].get(rotation_key)
+    if rotation is None:
+        if timing:
+            start = time.perf_counter()
+        rotation = rotate_aoi(mp_true, angle)
+        if timing:
+            profiler.record("rotation", start)
+        stage_caches["rotation"].put(rotation_key, rotation)
+    rotated_aoi_mask, rotated_mp_height, rotated_width = rotation
 
-    input_sc = sc.transform([[power, rpm, speed]])
+    tiling_key = (rotation_key, float(hatch_spacing), int(num_tracks))
+    surface = stage_caches["tiling"].get(tiling_key)
+    if surface is None:
+        if timing:
+            start = time.perf_counter()
+        surface = tile_tracks(
+            rotated_aoi_mask, rotated_width, hatch_spacing, num_tracks
+        )
+        if timing:
+            profiler.record("tiling", start)
+        stage_caches["tiling"].put(tiling_key, surface)
+
+    porosity_key = (tiling_key, int(num_layers), t_tol, t_max_steps)
+    search = stage_caches["porosity"].get(porosity_key)
+    if search is None:
+        if timing:
+            start = time.perf_counter()
+        try:
+            search = porosity_search(
+                surface,
+                rotated_mp_height,
+                num_layers,
+                tol=t_tol,
+                max_steps=t_max_steps,
+            )
+        except ValueError as e:
+            power, rpm, speed, _ = key
+            raise ValueError(
+                f"{e} (laser power {power}, scanning speed {speed}, rpm {rpm}, "
+                f"hatch spacing {float(hatch_spacing)})"
+            ) from e
+        if timing:
+            profiler.record("porosity", start, iterations=search[1])
+        stage_caches["porosity"].put(porosity_key, search)
+    t_ratio, iterations = search
+
+    return rotated_mp_height, t_ratio, iterations
+
+
+def predict_masks(power, rpm, speed, para2geom, para2geom_pca, sc):
+    # One scaler/network/PCA call for the whole batch -> stack of boolean masks
+    timing = profiler.enabled
+    if timing:
+        start = time.perf_counter()
+    input_sc = sc.transform(np.column_stack((power, rpm, speed)))
+    if timing:
+        profiler.record("scaling", start)
+        start = time.perf_counter()
     mp = para2geom.predict(input_sc, verbose=0)
+    if timing:
+        profiler.record("predict", start)
+        start = time.perf_counter()
     mp = para2geom_pca.inverse_transform(mp)
-    ret, mp_true = cv2.threshold(mp.reshape(resize_dim), 127, 255, cv2.THRESH_BINARY)
+    if timing:
+        profiler.record("pca_inverse", start)
+        start = time.perf_counter()
+    # Same pixels as cv2.threshold(..., 127, 255, cv2.THRESH_BINARY) on every mask
+    mp_true = (mp > 127).reshape(-1, *resize_dim)
+    if timing:
+        profiler.record("threshold", start)
+    return mp_true
+
 
-    mask_x = np.sum(mp_true, axis=0)
+def mask_extremes(mp_true):
+    # Column/row occupancy of every mask in the stack
+    mask_x = mp_true.any(axis=1)
+    mask_y = mp_true.any(axis=2)
     # Find the left-most x extreme value
-    x_ext_l = (mask_x != 0).argmax(axis=0)
+    x_ext_l = mask_x.argmax(axis=1)
     # Find the right-most x extreme value
-    x_ext_r = x_ext_l + np.count_nonzero(mask_x) - 1
-    # Select the point with the lowest y for the left-most x extreme
-    y_ext_l = (np.where(mp_true[:, x_ext_l] != 0)[0]).max()
-    # Select the point with the lowest y for the righht-most x extreme
-    y_ext_r = (np.where(mp_true[:, x_ext_r] != 0)[0]).max()
+    x_ext_r = x_ext_l + np.count_nonzero(mask_x, axis=1) - 1
+    # Select the point with the lowest y for the left-most and right-most x extremes
+    col_l = np.take_along_axis(mp_true, x_ext_l[:, None, None], axis=2)[..., 0]
+    col_r = np.take_along_axis(mp_true, x_ext_r[:, None, None], axis=2)[..., 0]
+    y_ext_l = resize_dim[0] - 1 - col_l[:, ::-1].argmax(axis=1)
+    y_ext_r = resize_dim[0] - 1 - col_r[:, ::-1].argmax(axis=1)
     # select the lower of the two for width measurement
-    y_ext = max(y_ext_l, y_ext_r)
+    y_ext = np.maximum(y_ext_l, y_ext_r)
 
     # Calculate the centres
     # y_centre = (y_ext_l+y_ext_r)/2
     y_centre = y_ext
 
-    mask_y = np.sum(mp_true, axis=1)
-    y_ext_high = (mask_y != 0).argmax(axis=0)
+    y_ext_high = mask_y.argmax(axis=1)
 
     # extract meltpool width and tilt angle from print bed
     # width = ((x_ext_l-x_ext_r)**2+(y_ext_l-y_ext_r)**2)**0.5*scale
     width = x_ext_r - x_ext_l
-    height = abs(y_ext_high - y_centre)
+    height = np.abs(y_ext_high - y_centre)
+    return width, height
 
-    # need to resize width and height from 96x96 image back to 550x550 image
-    angle = (
-        hs2angle.predict([[width / 96 * 550, speed, hatch_spacing, height / 96 * 550]])[
-            0
-        ]
-        if rotate
-        else 0
-    )
 
-    coords = np.argwhere(mp_true)
+def bounding_box(mask):
+    # (y_min, x_min, y_max, x_max) of the non-zero pixels, from the projections
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    return rows[0], cols[0], rows[-1], cols[-1]
+
 
+def rotate_aoi(mp_true, angle):
+    # Crops the melt pool and rotates it by the predicted tilt angle
     # Bounding box for the AOI
-    y_min, x_min = coords.min(axis=0)
-    y_max, x_max = coords.max(axis=0)
+    y_min, x_min, y_max, x_max = bounding_box(mp_true)
 
     # Extract AOI
     aoi = mp_true[max(y_min - 10, 0) : y_max + 10, max(x_min - 10, 0) : x_max + 10]
-    # Create the AOI mask
-    aoi_mask = (aoi > 0).astype(np.uint8)
 
     center = (aoi.shape[1] // 2, aoi.shape[0] // 2)
     rot_matrix = cv2.getRotationMatrix2D(center, 360 - angle, 1.0)
     # rotated size + 20 to avoid rotated image being cropped
+    # The extents are measured on the interpolated rotation, where any pixel
+    # touched by the melt pool is non-zero. The bilinear weights are multiples of
+    # 1/1024, so rounding it gives exactly the rotation of the uint8 mask that
+    # the tracks are tiled with
     rotated_aoi = cv2.warpAffine(
-        aoi, rot_matrix, (aoi.shape[1] + 50, aoi.shape[0] + 50)
-    )
-    rotated_aoi_mask = cv2.warpAffine(
-        aoi_mask, rot_matrix, (aoi_mask.shape[1] + 50, aoi_mask.shape[0] + 50)
+        aoi.astype(np.float32), rot_matrix, (aoi.shape[1] + 50, aoi.shape[0] + 50)
     )
+    rotated_aoi_mask = rotated_aoi >= 0.5
+    # Tiling only depends on the pixel positions relative to each other, so the
+    # mask is cropped to them
+    mask_y_min, mask_x_min, mask_y_max, mask_x_max = bounding_box(rotated_aoi_mask)
+    rotated_aoi_mask = rotated_aoi_mask[
+        mask_y_min : mask_y_max + 1, mask_x_min : mask_x_max + 1
+    ].copy()
 
-    # Used to calculate the furtherest point after rotation
-    coords_mp = np.argwhere(aoi)
-    _, x_idx_max_mp = np.argmax(coords_mp, axis=0)
+    # Used to calculate the furtherest point after rotation: the right most
+    # column of the AOI, at its top-most pixel
+    x_right = np.flatnonzero(aoi.any(axis=0))[-1]
+    y_right = aoi[:, x_right].argmax()
 
     # Convert the point to homogeneous coordinates. Points selected are the right most point
     # Note that x and y order needs to be changed due to the stupidest way cv2 handles x and y
-    right_most_homogeneous = np.array(
-        [coords_mp[x_idx_max_mp][1], coords_mp[x_idx_max_mp][0], 1]
-    )
+    right_most_homogeneous = np.array([x_right, y_right, 1])
 
     # Apply the rotation matrix to the point
     right_most_new = np.dot(rot_matrix, right_most_homogeneous)
 
-    coords_mp_rotated = np.argwhere(rotated_aoi)
-    y_min, x_min = coords_mp_rotated.min(axis=0)
-    y_max, x_max = coords_mp_rotated.max(axis=0)
+    y_min, x_min, y_max, x_max = bounding_box(rotated_aoi)
 
     rotated_mp_height = right_most_new[1] - y_min
 
-    spacing = (x_max - x_min) * hatch_spacing
+    return _frozen(rotated_aoi_mask), rotated_mp_height, x_max - x_min
 
-    # Create a new image to place the patterned AOI. Need to be large enough
-    patterned_image = np.zeros((1000, 1000))
 
-    # Place the AOI repeatedly in the new image
-    for i in range(num_tracks):
-        x_offset = i * spacing
-        y_offset = 30  # Assuming we place it at the top of the image
+def tile_tracks(rotated_aoi_mask, rotated_width, hatch_spacing, num_tracks):
+    # Places `num_tracks` side by side tracks to build the deposited surface
+    spacing = rotated_width * hatch_spacing
+    offsets = (np.arange(num_tracks) * spacing).astype(int)
 
-        x_offset = int(x_offset)
-        y_offset = int(y_offset)
+    # The patterned AOIs span the rows of one track, from the left of the first
+    # track to the right of the last one. Only that part is built, and cropped
+    # as before (without the last row and column)
+    y_min, x_min, y_max, x_max = bounding_box(rotated_aoi_mask)
+    mask = rotated_aoi_mask[y_min:y_max, x_min : x_max + 1]
+    width = offsets[-1] + x_max - x_min
+    if num_tracks == 1:
+        return _frozen(mask[:, :width].copy())
 
-        # Define the region of interest in the destination image
-        roi = patterned_image[
-            y_offset : y_offset + rotated_aoi.shape[0],
-            x_offset : x_offset + rotated_aoi.shape[1],
-        ]
-        roi_mask = rotated_aoi_mask
-
-        # Update only the AOI regions using the mask
-        np.copyto(roi, rotated_aoi, where=roi_mask.astype(bool))
-
-    # Crop the image to the width of the patterned AOIs
-    coords_patterned = np.argwhere(patterned_image)
-    y_min_patterned, x_min_patterned = coords_patterned.min(axis=0)
-    y_max_patterned, x_max_patterned = coords_patterned.max(axis=0)
-    surface_padding = 0  # extrat pattern to prevent unnecessary crop
-    patterned_image = patterned_image[
-        y_min_patterned - surface_padding : y_max_patterned + surface_padding,
-        x_min_patterned : x_max_patterned + surface_padding,
-    ]
-
-    ds_cal_image = patterned_image.copy()
-    ds_cal_image[ds_cal_image > 0] = 1
-
-    surface, layer_height, surface_padding = (
-        patterned_image,
-        rotated_mp_height,
-        surface_padding,
-    )
-
-    # Create the AOI mask
-    surface_mask = (surface > 0).astype(np.uint8)
-    # ratio of overlap in height
-    t_ratio = 1
-    counter = 0
-    # Place the surface repeatedly in the new image until there is no zero values in the centre 50%
-    while True:
-        # Establish an array of all zero
-        cube = np.zeros((1000, surface.shape[1]))
-        cube_to_check = np.zeros((1000, surface.shape[1]))
-        # Calculate the current layer thickness
+    # The surface is the maximum of the mask shifted by every track offset, i.e.
+    # its dilation by a row kernel with a one at each offset (from the right)
+    track = np.zeros((len(mask), width), np.uint8)
+    track[:, : mask.shape[1]] = mask[:, :width]
+    kernel = np.zeros((1, offsets[-1] + 1), np.uint8)
+    kernel[0, offsets[-1] - offsets] = 1
+    patterned_image = cv2.dilate(
+        track,
+        kernel,
+        anchor=(offsets[-1], 0),
+        borderType=cv2.BORDER_CONSTANT,
+        borderValue=0,
+    )
+
+    return _frozen(patterned_image.view(bool))
+
+
+def porosity_search(
+    surface,
+    layer_height,
+    num_layers,
+    surface_padding=0,
+    tol=0.01,
+    max_steps=None,
+):
+    """
+    Lowers the layer overlap ratio `t_ratio` from 1 in steps of `tol` until the
+    porosity in the centre of the stacked layers falls to 10% of its initial value.
+
+    Every step is tried in order, but porosity only depends on the integer layer
+    thickness and on which side the first layer faces, so a stacked composition
+    is only evaluated the first time a step reaches it. `t_ratio` goes down at
+    most `max_steps` times (by default until it reaches 0). Returns `t_ratio`
+    and the number of stacked compositions evaluated, and raises a ValueError
+    when no positive `t_ratio` is dense.
+    """
+    kernel = PorosityKernel(surface, layer_height, num_layers, surface_padding)
+
+    # The surface is flipped once per layer and never reset, so the side the
+    # first layer faces alternates with the step when `num_layers` is odd
+    evaluated = {}
+
+    def dense(step, t_ratio):
         layer_t = int(layer_height * t_ratio)
+        flipped = (step * num_layers) % 2 == 1
+        if (layer_t, flipped) not in evaluated:
+            evaluated[layer_t, flipped] = kernel.porosity(layer_t, flipped)
+        # Check pores
+        return evaluated[layer_t, flipped] <= porosity_init * 0.1
 
-        # Pattern the layers
-        for i in range(num_layers):
-            x_offset = 0
-            total_height = num_layers * surface.shape[0]
+    porosity_init = kernel.porosity(int(layer_height), False)
+    evaluated[int(layer_height), False] = porosity_init
 
-            # Define the region of interest in the destination image
-            roi = cube[
-                total_height - surface.shape[0] - layer_t * i : total_height
-                - layer_t * i,
-                x_offset : x_offset + surface.shape[1],
-            ]
-            roi_to_check = cube_to_check[
-                total_height - surface.shape[0] - layer_t * i : total_height
-                - surface.shape[0]
-                - layer_t * i
-                + surface_mask[0 : int(layer_height) + surface_padding, :].shape[0],
-                x_offset : x_offset + surface.shape[1],
-            ]
+    step, t_ratio = 0, 1
+    while not dense(step, t_ratio):
+        # Same floating point values as the original loop
+        step, t_ratio = step + 1, t_ratio - tol
+        # A zero or negative t_ratio would never finish the part in generate_gcode
+        if t_ratio < tol / 2 or (max_steps is not None and step > max_steps):
+            raise ValueError("No layer overlap ratio makes the stacked layers dense")
+    return t_ratio, len(evaluated)
 
-            # Update only the AOI regions using the mask
-            np.copyto(roi, surface, where=surface_mask.astype(bool))
-            np.copyto(
-                roi_to_check,
-                surface[0 : int(layer_height) + surface_padding, :],
-                where=surface_mask[0 : int(layer_height) + surface_padding, :].astype(
-                    bool
-                ),
-            )
 
-            surface = np.fliplr(surface)
-            surface_mask = np.fliplr(surface_mask)
-        # Crop the image to the width of the patterned AOIs
-        coords_cube = np.argwhere(cube)
-        y_min_cube, x_min_cube = coords_cube.min(axis=0)
-        y_max_cube, x_max_cube = coords_cube.max(axis=0)
-        cube = cube[(y_min_cube - 1) : (y_max_cube + 1), x_min_cube : (x_max_cube + 1)]
-        cube_to_check = cube_to_check[
-            (y_min_cube - 1) : (y_max_cube + 1), x_min_cube : (x_max_cube + 1)
-        ]
+class PorosityKernel:
+    """
+    Porosity of `num_layers` stacked copies of a surface, counted only over the
+    centre 50% window that is evaluated.
 
-        cube_to_check_centre = cube_to_check[
-            int(cube.shape[0] * 0.25) : int(cube.shape[0] * 0.75),
-            int(cube.shape[1] * 0.25) : int(cube.shape[1] * 0.75),
-        ]
+    The cube extents are derived from the surface projections instead of being
+    searched in a composited image, and the checked region is kept as per-layer
+    coverage counts restricted to the window columns. Changing the layer thickness
+    then only moves the layers whose offset changed.
+    """
 
-        if counter == 0:
-            porosity_init = np.count_nonzero(cube_to_check_centre == 0)
+    # Height of the canvas the layers used to be composited on. Only needed to
+    # reproduce how the crop behaves when the top layer touches the first row
+    canvas_height = 1000
 
-        porosity = np.count_nonzero(cube_to_check_centre == 0)
-        counter = counter + 1
-        # Check pores
-        if porosity <= porosity_init * 0.1:
-            break
-        else:
-            t_ratio = t_ratio - 0.01
+    def __init__(self, surface_mask, layer_height, num_layers, surface_padding=0):
+        mask = np.asarray(surface_mask) != 0
+        self.height, width = mask.shape
+        self.num_layers = num_layers
+        self.total_height = num_layers * self.height
+        # Only the top of each layer is checked for pores
+        self.check_height = mask[0 : int(layer_height) + surface_padding].shape[0]
 
-    return width * scale, layer_height * scale, t_ratio
+        rows = np.flatnonzero(mask.any(axis=1))
+        self.row_first, self.row_last = rows[0], rows[-1]
+        # With a negative melt pool height the layers stack upwards, below the
+        # rows of the first one; the layer thickness never exceeds int(layer_height)
+        canvas_rows = self.total_height + (num_layers - 1) * max(-int(layer_height), 0)
+        canvas_rows = min(canvas_rows, PorosityKernel.canvas_height)
+
+        columns = mask.any(axis=0)
+        self._orientations = {}
+        for flipped in (False, True):
+            # Columns covered by the layers, the surface is mirrored every layer
+            used = columns[::-1] if flipped else columns
+            if num_layers > 1:
+                used = columns | columns[::-1]
+            used = np.flatnonzero(used)
+            cube_width = used[-1] - used[0] + 1
+            col_start = used[0] + int(cube_width * 0.25)
+            col_stop = used[0] + int(cube_width * 0.75)
+
+            top = mask[0 : self.check_height, col_start:col_stop].astype(np.int16)
+            top_flipped = mask[0 : self.check_height, ::-1][
+                :, col_start:col_stop
+            ].astype(np.int16)
+            self._orientations[flipped] = {
+                "stamps": [
+                    top_flipped if (flipped ^ (i % 2 == 1)) else top
+                    for i in range(num_layers)
+                ],
+                "coverage": scratch.zeros(
+                    f"coverage_{int(flipped)}",
+                    (canvas_rows, col_stop - col_start),
+                    np.int16,
+                ),
+                "offsets": [None] * num_layers,
+            }
+
+    def porosity(self, layer_t, flipped=False):
+        offsets = [
+            self.total_height - self.height - layer_t * i
+            for i in range(self.num_layers)
+        ]
+        if min(offsets) < 0 or self.total_height > PorosityKernel.canvas_height:
+            raise ValueError("The stacked layers do not fit in the porosity canvas")
+
+        state = self._orientations[flipped]
+        coverage = state["coverage"]
+        for i, (stamp, old, new) in enumerate(
+            zip(state["stamps"], state["offsets"], offsets)
+        ):
+            if old == new:
+                continue
+            if old is not None:
+                coverage[old : old + self.check_height] -= stamp
+            coverage[new : new + self.check_height] += stamp
+            state["offsets"][i] = new
+
+        # Crop to the stacked layers (one empty row above), then take the centre
+        start, stop, _ = slice(
+            min(offsets) + self.row_first - 1, max(offsets) + self.row_last + 1
+        ).indices(PorosityKernel.canvas_height)
+        cube_height = max(stop - start, 0)
+        window = coverage[
+            start + int(cube_height * 0.25) : start + int(cube_height * 0.75)
+        ]
+        return window.size - np.count_nonzero(window)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent cache and checkpoints of melt pool geometry predictions
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+KEY_COLUMNS = (
+    "power",
+    "speed",
+    "rpm",
+    "hatch_spacing",
+    "rotate",
+    "num_tracks",
+    "num_layers",
+    "t_tol",
+    "t_max_steps",
+)
+VALUE_COLUMNS = ("width", "layer_height", "t_ratio")
+# SQLite type of the key columns that are not REAL
+KEY_TYPES = {"t_max_steps": "INTEGER"}
+# Tables of an older version are dropped and created again
+SCHEMA_VERSION = 2
+
+
+class PredictionCache:
+    """
+    SQLite backed cache of `meltpool_geom_cal` results.
+
+    Entries are keyed by the process parameters, the geometry and t_ratio step
+    settings and a hash of the model files, so retrained models never reuse stale
+    predictions. The cache holds at most `max_entries` rows and evicts the least
+    recently used ones.
+    """
+
+    def __init__(self, path, model_hash: str, max_entries: int = 200_000) -> None:
+        self.path = Path(path)
+        self.model_hash = model_hash
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path))
+        (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self._conn.execute("DROP TABLE IF EXISTS predictions")
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        key_columns = (f"{c} {KEY_TYPES.get(c, 'REAL')} NOT NULL" for c in KEY_COLUMNS)
+        self._conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS predictions (
+                model_hash TEXT NOT NULL,
+                {", ".join(key_columns)},
+                {", ".join(f"{c} REAL NOT NULL" for c in VALUE_COLUMNS)},
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model_hash, {", ".join(KEY_COLUMNS)})
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(
+        power,
+        speed,
+        rpm,
+        hatch_spacing,
+        rotate,
+        num_tracks,
+        num_layers,
+        t_tol,
+        t_max_steps,
+    ) -> tuple:
+        return (
+            float(power),
+            float(speed),
+            float(rpm),
+            float(hatch_spacing),
+            int(bool(rotate)),
+            int(num_tracks),
+            int(num_layers),
+            float(t_tol),
+            # No limit is stored as -1, NULL never compares equal
+            -1 if t_max_steps is None else int(t_max_steps),
+        )
+
+    def get_many(self, keys: list) -> list:
+        # Returns (width, layer_height, t_ratio) for every cached key and None otherwise
+        now = time.time()
+        where = " AND ".join(f"{c} = ?" for c in ("model_hash",) + KEY_COLUMNS)
+        results = []
+        found = []
+        for key in keys:
+            row = self._conn.execute(
+                f"SELECT {', '.join(VALUE_COLUMNS)} FROM predictions WHERE {where}",
+                (self.model_hash, *key),
+            ).fetchone()
+            results.append(row)
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                found.append((now, self.model_hash, *key))
+        if found:
+            self._conn.executemany(
+                f"UPDATE predictions SET last_used = ? WHERE {where}", found
+            )
+            self._conn.commit()
+        return results
+
+    def put_many(self, keys: list, values: list) -> None:
+        now = time.time()
+        columns = ("model_hash",) + KEY_COLUMNS + VALUE_COLUMNS + ("last_used",)
+        self._conn.executemany(
+            f"INSERT OR REPLACE INTO predictions ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            [
+                (self.model_hash, *key, *map(float, value), now)
+                for key, value in zip(keys, values)
+            ],
+        )
+        self._evict()
+        self._conn.commit()
+
+    def _evict(self) -> None:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM predictions WHERE rowid IN "
+                "(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()
+        return count
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self) -> None:
+        self._conn.execute("DELETE FROM predictions")
+        self._conn.commit()
+        self.reset_stats()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class PredictionCheckpoint:
+    """
+    Predictions for the rows of one CSV, appended to a checkpoint file as they
+    are computed so that an interrupted run can resume.
+
+    The first line of the file holds `settings` (model hash and geometry
+    settings) as JSON. A checkpoint written with other settings is discarded, and
+    rows are only reused while their process parameters are unchanged.
+    """
+
+    COLUMNS = ("row", "power", "speed", "rpm", "hatch_spacing") + VALUE_COLUMNS
+
+    def __init__(self, path, settings: dict) -> None:
+        self.path = Path(path)
+        self.settings = settings
+        self.resumed = 0
+
+    def load(self, power, speed, rpm, hatch_spacing) -> dict:
+        # Returns {row: (width, layer_height, t_ratio)} for the completed rows
+        completed = {}
+        if self.path.exists():
+            lines = self.path.read_text().split("\n")
+            # The last line is complete only when the file ends with a newline
+            lines = lines[:-1]
+            try:
+                valid = json.loads(lines[0]) == self.settings
+                valid = valid and lines[1] == ",".join(self.COLUMNS)
+            except (ValueError, IndexError):
+                valid = False
+            if valid:
+                for line in csv.reader(lines[2:]):
+                    try:
+                        row, *values = _float_row(line, len(self.COLUMNS))
+                        row = int(row)
+                        parameters = (
+                            power[row],
+                            speed[row],
+                            rpm[row],
+                            hatch_spacing[row],
+                        )
+                    except (ValueError, IndexError):
+                        # Line from an interrupted write, or a row no longer there
+                        continue
+                    if tuple(values[:4]) == tuple(map(float, parameters)):
+                        completed[row] = tuple(values[4:])
+            else:
+                self.remove()
+        self.resumed = len(completed)
+        return completed
+
+    def append(self, rows, power, speed, rpm, hatch_spacing, values) -> None:
+        # Writes the rows and flushes them to disk before returning
+        new = not self.path.exists() or self.path.stat().st_size == 0
+        if not new:
+            # Ends a line cut short by an interruption, which loading skips
+            with open(self.path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                cut = file.read(1) != b"\n"
+        with open(self.path, "w" if new else "a", newline="") as file:
+            if not new and cut:
+                file.write("\n")
+            writer = csv.writer(file, lineterminator="\n")
+            if new:
+                file.write(json.dumps(self.settings) + "\n")
+                writer.writerow(self.COLUMNS)
+            writer.writerows(
+                (int(row), *map(repr, map(float, (p, s, r, h, *value))))
+                for row, p, s, r, h, value in zip(
+                    rows, power, speed, rpm, hatch_spacing, values
+                )
+            )
+            file.flush()
+            os.fsync(file.fileno())
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def _float_row(line: list, length: int) -> list:
+    if len(line) != length:
+        raise ValueError("Incomplete checkpoint line")
+    return [float(value) for value in line]
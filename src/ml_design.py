@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process parameter design with the melt pool geometry model
+
+    python src/ml_design.py inverse --width 1.0 --layer-height 0.3 -o design.csv
+
+searches the process window for the parameters giving a target bead geometry and
+writes the best candidates as a CSV that can be used to generate G-Code.
+
+    python src/ml_design.py build-rate parts.csv --length 5 --height 5 -o fast.csv
+
+picks, for every part (row) of a G-Code CSV, the parameters with the highest
+deposition rate that keep its track width and a dense overlap; the `layers`
+command picks the ones reaching the part height in the fewest layers instead.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from ml import meltpool_geom_cal_batch
+from ml_server import use_server
+
+PARAMETERS = ("power", "speed", "rpm", "hatch_spacing")
+# Resolution the parameters are rounded to, as set on the machine
+DECIMALS = {"power": 2, "speed": 1, "rpm": 2, "hatch_spacing": 2}
+# Bounds covering the process window of the example CSV
+DEFAULT_BOUNDS = {
+    "power": (30.0, 60.0),
+    "speed": (200.0, 800.0),
+    "rpm": (0.3, 0.7),
+    "hatch_spacing": (0.3, 0.3),
+}
+
+
+def sample_candidates(bounds: dict, n: int, rng, centres=None, spread=1.0) -> dict:
+    """
+    Draws `n` parameter sets within `bounds`: uniformly, or around `centres`
+    (arrays of parameters) with a normal spread of `spread` times each range.
+    """
+    if centres is not None:
+        # Every candidate is drawn around one of the centres, for all parameters
+        picked = rng.integers(len(centres["power"]), size=n)
+    candidates = {}
+    for name in PARAMETERS:
+        low, high = bounds[name]
+        if centres is None:
+            values = rng.uniform(low, high, n)
+        else:
+            values = centres[name][picked] + rng.normal(0, spread * (high - low), n)
+        candidates[name] = np.round(np.clip(values, low, high), DECIMALS[name])
+    return candidates
+
+
+def evaluate(candidates: dict, num_tracks=5, num_layers=3, lut=None, workers=1):
+    """
+    Predicted geometry of every parameter set as a DataFrame. `layer_height` is
+    the height a layer adds, i.e. bead height x t_ratio (mm), as in generate_gcode.
+
+    With a `ProcessWindowLUT` built for the same settings, predictions use its
+    fast mode.
+    """
+    args = tuple(candidates[name] for name in PARAMETERS)
+    if lut is not None:
+        if (lut.settings["num_tracks"], lut.settings["num_layers"]) != (
+            num_tracks,
+            num_layers,
+        ):
+            raise ValueError("The lookup table was built for other geometry settings")
+        width, height, t_ratio = lut.predict(*args)
+    else:
+        width, height, t_ratio = _predict(*args, num_tracks, num_layers, workers)
+    return pd.DataFrame(
+        {
+            **{name: np.asarray(candidates[name], dtype=float) for name in PARAMETERS},
+            "width": width,
+            "height": height,
+            "t_ratio": t_ratio,
+            "layer_height": height * t_ratio,
+        }
+    )
+
+
+def _predict(power, speed, rpm, hatch_spacing, num_tracks, num_layers, workers):
+    # Exact geometry, NaN for the candidates that fail (e.g. no dense overlap)
+    kwargs = dict(num_tracks=num_tracks, num_layers=num_layers)
+    try:
+        return meltpool_geom_cal_batch(
+            power, speed, rpm, hatch_spacing, workers=workers, **kwargs
+        )
+    except Exception:
+        values = np.full((3, len(power)), np.nan)
+        for i in range(len(power)):
+            try:
+                values[:, i] = np.ravel(
+                    meltpool_geom_cal_batch(
+                        power[i], speed[i], rpm[i], hatch_spacing[i], **kwargs
+                    )
+                )
+            except Exception:
+                pass
+        return tuple(values)
+
+
+def search(score, bounds, samples=2000, rounds=3, elite=20, seed=0, **kwargs):
+    """
+    Minimizes `score(DataFrame) -> array` over the parameter space: a uniform
+    batch of `samples` candidates, then `rounds` batches drawn around the `elite`
+    best ones so far with a shrinking spread. Returns every distinct candidate
+    evaluated, best first, with its score; candidates whose geometry could not
+    be predicted score inf. `kwargs` go to `evaluate`.
+    """
+    rng = np.random.default_rng(seed)
+    evaluated = None
+    centres = None
+    for i in range(rounds + 1):
+        candidates = sample_candidates(bounds, samples, rng, centres, 0.2 / 2**i)
+        batch = evaluate(candidates, **kwargs)
+        batch["score"] = np.nan_to_num(score(batch), nan=np.inf)
+        evaluated = (
+            batch
+            if evaluated is None
+            else pd.concat((evaluated, batch), ignore_index=True)
+        )
+        evaluated = evaluated.drop_duplicates(list(PARAMETERS)).sort_values("score")
+        centres = {name: evaluated[name].to_numpy()[:elite] for name in PARAMETERS}
+    return evaluated.reset_index(drop=True)
+
+
+def inverse_design(
+    target_width, target_layer_height, bounds=None, top=10, **kwargs
+) -> pd.DataFrame:
+    """
+    Parameter sets whose predicted width and layer height (mm) are closest to the
+    targets, ranked by the root mean square of their relative errors.
+    `kwargs` go to `search` and `evaluate`.
+    """
+    bounds = {**DEFAULT_BOUNDS, **(bounds or {})}
+
+    def score(batch):
+        width_error = batch["width"] / target_width - 1
+        layer_error = batch["layer_height"] / target_layer_height - 1
+        return np.sqrt((width_error**2 + layer_error**2) / 2)
+
+    ranked = search(score, bounds, **kwargs)
+    ranked = ranked[np.isfinite(ranked["score"])].head(top)
+    return ranked.rename(columns={"score": "error"})
+
+
+def maximize_build_rate(
+    min_width,
+    shape="Cube",
+    bounds=None,
+    top=10,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Parameter sets with the highest volumetric deposition rate (mm^3/s) whose
+    predicted width is at least `min_width` (mm), the `top` best or all of them
+    with `top=None`. Sets whose layers never overlap into a dense stack fail
+    the geometry prediction and are left out. `kwargs` go to `search` and
+    `evaluate`.
+    """
+    bounds = {**DEFAULT_BOUNDS, **(bounds or {})}
+
+    def score(batch):
+        rate = build_rate(shape, batch)
+        return np.where(batch["width"] >= min_width, -rate, np.inf)
+
+    kwargs.setdefault("num_tracks", 5 if shape == "Cube" else 1)
+    ranked = search(score, bounds, **kwargs)
+    ranked = ranked[np.isfinite(ranked["score"])]
+    if top is not None:
+        ranked = ranked.head(top)
+    return ranked.drop(columns="score").assign(build_rate=build_rate(shape, ranked))
+
+
+def build_rate(shape, geometry) -> np.ndarray:
+    # Deposited volume per second: the layer height times the track step (Cube)
+    # or the track width (Thin Wall) times the scanning speed (mm/min)
+    step = geometry["width"] * (geometry["hatch_spacing"] if shape == "Cube" else 1)
+    return np.asarray(step * geometry["layer_height"] * geometry["speed"] / 60)
+
+
+def print_time(shape, length, height, geometry) -> np.ndarray:
+    """
+    Deposition time (s) of one part laid out as generate_gcode does: layers
+    `height` x `t_ratio` apart until the part `height` is passed, and in a Cube,
+    tracks `hatch_spacing` x `width` apart across the `length`. Pauses and
+    travel moves are not counted.
+    """
+    layers = count_layers(height, geometry["height"], geometry["t_ratio"])
+    tracks = 1
+    if shape == "Cube":
+        tracks = np.floor(length / (geometry["hatch_spacing"] * geometry["width"])) + 1
+    return np.asarray(layers * tracks * length / geometry["speed"] * 60)
+
+
+def count_layers(height, bead_height, t_ratio) -> np.ndarray:
+    # generate_gcode adds layers while the deposited height is at most `height`
+    with np.errstate(divide="ignore"):
+        return np.floor(height / (np.asarray(bead_height) * t_ratio)) + 1
+
+
+def part_geometry(parts: pd.DataFrame, shape="Cube", **kwargs) -> pd.DataFrame:
+    """
+    Process parameters and geometry of the rows of a G-Code CSV, as
+    generate_gcode would print them: width and height are predicted when the CSV
+    has no such column and the layer overlap defaults to 1. `kwargs` go to
+    `evaluate`.
+    """
+    geometry = pd.DataFrame(
+        {
+            "power": parts["laser_power"].to_numpy(dtype=float),
+            "speed": parts["scanning_speed"].to_numpy(dtype=float),
+            "rpm": (parts.get("rpm_1", 0) + parts.get("rpm_2", 0)).to_numpy(float),
+            "hatch_spacing": parts.get("hatch_spacing", 1),
+        }
+    )
+    if "width" not in parts or "height" not in parts:
+        predicted = evaluate(geometry, num_tracks=5 if shape == "Cube" else 1, **kwargs)
+    for column in ("width", "height"):
+        geometry[column] = (
+            parts[column] if column in parts else predicted[column]
+        ).to_numpy(dtype=float)
+    geometry["t_ratio"] = parts["layer_height"] if "layer_height" in parts else 1.0
+    geometry["layer_height"] = geometry["height"] * geometry["t_ratio"]
+    return geometry
+
+
+def minimize_layers(
+    height,
+    min_width=0,
+    shape="Cube",
+    length=None,
+    bounds=None,
+    top=10,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    Parameter sets that reach the part `height` (mm) in the fewest layers with a
+    width of at least `min_width` (mm), the `top` best or all of them with
+    `top=None`. Ties go to the shortest print time, which needs the part `length`
+    (mm). Sets whose layers never overlap into a dense stack fail the geometry
+    prediction and are left out. `kwargs` go to `search` and `evaluate`.
+    """
+    bounds = {**DEFAULT_BOUNDS, **(bounds or {})}
+
+    def score(batch):
+        layers = count_layers(height, batch["height"], batch["t_ratio"])
+        time = print_time(shape, length, height, batch) if length else 0
+        # The fraction below 1 only orders sets with the same number of layers
+        score = layers + time / (1 + time)
+        return np.where(batch["width"] >= min_width, score, np.inf)
+
+    kwargs.setdefault("num_tracks", 5 if shape == "Cube" else 1)
+    ranked = search(score, bounds, **kwargs)
+    ranked = ranked[np.isfinite(ranked["score"])].drop(columns="score")
+    if top is not None:
+        ranked = ranked.head(top)
+    # Not named `layers`, which generate_gcode reads as the layers printed per row
+    return ranked.assign(
+        planned_layers=count_layers(height, ranked["height"], ranked["t_ratio"])
+    )
+
+
+def plan_build_rate(
+    parts: pd.DataFrame, shape, length, height, min_width=None, buckets=8, **kwargs
+) -> pd.DataFrame:
+    """
+    For every part (row of a G-Code CSV) the fastest parameter set from
+    `maximize_build_rate`, keeping at least the part's own track width unless
+    `min_width` is given, with its print time and the saving against the CSV.
+    See `_plan` for `buckets`.
+    """
+    plan, _ = _plan(
+        parts,
+        shape,
+        length,
+        height,
+        min_width,
+        buckets,
+        lambda width: maximize_build_rate(width, shape, top=None, **kwargs),
+        ["build_rate"],
+        False,
+        kwargs.get("workers", 1),
+    )
+    return plan
+
+
+def plan_layers(
+    parts: pd.DataFrame, shape, length, height, min_width=None, buckets=8, **kwargs
+) -> pd.DataFrame:
+    """
+    For every part (row of a G-Code CSV) the parameter set from
+    `minimize_layers`, keeping at least the part's own track width unless
+    `min_width` is given, with its number of layers and print time and their
+    reduction against the CSV. See `_plan` for `buckets`.
+    """
+    plan, current = _plan(
+        parts,
+        shape,
+        length,
+        height,
+        min_width,
+        buckets,
+        lambda width: minimize_layers(height, width, shape, length, top=None, **kwargs),
+        ["planned_layers", "print_time"],
+        True,
+        kwargs.get("workers", 1),
+    )
+    plan["current_layers"] = count_layers(height, current["height"], current["t_ratio"])
+    plan["layer_reduction"] = plan["current_layers"] - plan["planned_layers"]
+    return plan
+
+
+def _plan(
+    parts, shape, length, height, min_width, buckets, ranked, by, ascending, workers
+):
+    # Best parameter set per part and the geometry the CSV would print with.
+    # Predicted widths differ for every part, so `ranked(width)` is only searched
+    # for `buckets` widths spread over the ones the parts need (always with the
+    # widest); the sets found are pooled, sorted by the columns `by`, and each
+    # part takes the first one at least as wide as it needs
+    current = part_geometry(parts, shape, workers=workers)
+    widths = np.asarray(
+        current["width"] if min_width is None else np.full(len(parts), min_width),
+        dtype=float,
+    )
+    if np.isnan(widths).any():
+        raise ValueError("The track width of some parts could not be predicted")
+    spread = np.quantile(widths, np.linspace(0, 1, buckets), method="lower")
+    searched = np.unique(np.append(spread, widths.max()))
+    pool = pd.concat([ranked(width) for width in searched], ignore_index=True)
+    pool = pool.drop_duplicates(list(PARAMETERS))
+    pool["print_time"] = print_time(shape, length, height, pool)
+    pool = pool.sort_values(by, ascending=ascending, kind="stable")
+
+    # First set of the pool wide enough for each part
+    reach = np.maximum.accumulate(pool["width"].to_numpy())
+    first = np.searchsorted(reach, widths)
+    if (first == len(pool)).any():
+        raise ValueError("No parameter set meets the width and porosity criteria")
+    plan = pool.iloc[first].reset_index(drop=True)
+    plan["current_print_time"] = print_time(shape, length, height, current)
+    plan["time_saving"] = plan["current_print_time"] - plan["print_time"]
+    return plan, current
+
+
+def to_generation_csv(candidates: pd.DataFrame, path) -> pd.DataFrame:
+    # Columns read by generate_gcode; the powder feed goes to hopper 1
+    data = pd.DataFrame(
+        {
+            "idx": np.arange(1, len(candidates) + 1),
+            "laser_power": candidates["power"].to_numpy(),
+            "scanning_speed": candidates["speed"].to_numpy(),
+            "rpm_1": candidates["rpm"].to_numpy(),
+            "rpm_2": 0,
+            "width": candidates["width"].to_numpy(),
+            "height": candidates["height"].to_numpy(),
+            "hatch_spacing": candidates["hatch_spacing"].to_numpy(),
+            "layer_height": candidates["t_ratio"].to_numpy(),
+        }
+    )
+    # Scores and estimates are kept after the columns generate_gcode reads
+    written = {*data, *PARAMETERS, "t_ratio", "layer_height"}
+    for column in candidates.columns:
+        if column not in written:
+            data[column] = candidates[column].to_numpy()
+    data.to_csv(path, index=False)
+    return data
+
+
+def _bounds_arguments(parser) -> None:
+    for name in PARAMETERS:
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=float,
+            nargs=2,
+            metavar=("MIN", "MAX"),
+            default=DEFAULT_BOUNDS[name],
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Process parameter design")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    inverse = commands.add_parser("inverse", help="find parameters for a geometry")
+    inverse.add_argument("--width", type=float, required=True)
+    inverse.add_argument("--layer-height", type=float, required=True)
+    inverse.add_argument("--top", type=int, default=10)
+    _bounds_arguments(inverse)
+
+    rate = commands.add_parser("build-rate", help="fastest parameters per part")
+    layers = commands.add_parser("layers", help="fewest layers per part")
+    for command in (rate, layers):
+        command.add_argument("csv", help="G-Code CSV with the parts to print")
+        command.add_argument("--length", type=float, required=True)
+        command.add_argument("--height", type=float, required=True)
+        command.add_argument("--min-width", type=float, help="instead of each part's")
+        _bounds_arguments(command)
+
+    for command in commands.choices.values():
+        command.add_argument("--shape", choices=("Thin Wall", "Cube"), default="Cube")
+        command.add_argument("--samples", type=int, default=2000)
+        command.add_argument("--rounds", type=int, default=3)
+        command.add_argument("--workers", type=int, default=1)
+        command.add_argument("--lut", help="lookup table directory (fast mode)")
+        command.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+    use_server()
+
+    kwargs = dict(
+        num_tracks=5 if args.shape == "Cube" else 1,
+        samples=args.samples,
+        rounds=args.rounds,
+        workers=args.workers,
+    )
+    if args.lut:
+        from ml_lut import ProcessWindowLUT
+
+        kwargs["lut"] = ProcessWindowLUT.load(args.lut)
+    bounds = {name: tuple(getattr(args, name)) for name in PARAMETERS}
+
+    if args.command == "inverse":
+        result = inverse_design(
+            args.width, args.layer_height, bounds, top=args.top, **kwargs
+        )
+    else:
+        plan = plan_build_rate if args.command == "build-rate" else plan_layers
+        result = plan(
+            pd.read_csv(args.csv),
+            args.shape,
+            args.length,
+            args.height,
+            args.min_width,
+            bounds=bounds,
+            **kwargs,
+        )
+        if args.command == "layers":
+            print(
+                f"Layers {result['current_layers'].sum():.0f} -> "
+                f"{result['planned_layers'].sum():.0f}"
+            )
+        saving = result["time_saving"].sum() / result["current_print_time"].sum()
+        print(
+            f"Print time {result['current_print_time'].sum():.0f} s -> "
+            f"{result['print_time'].sum():.0f} s ({saving:.0%} saved)"
+        )
+    print(to_generation_csv(result, args.output).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed melt pool geometry over a grid of process parameters
+
+Build a table once (offline) with
+
+    python src/ml_lut.py build <directory> --num-tracks 5
+
+and load it with `ProcessWindowLUT.load(<directory>)` to interpolate predictions
+in microseconds instead of running `meltpool_geom_cal`.
+"""
+
+import argparse
+import itertools
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from ml import meltpool_geom_cal_batch, model_hash
+from ml_server import use_server
+
+AXES = ("power", "rpm", "speed", "hatch_spacing")
+OUTPUTS = ("width", "layer_height", "t_ratio")
+
+# (min, max, points), covering the process window of the example CSV with margin
+DEFAULT_GRID = {
+    "power": (30.0, 60.0, 16),
+    "rpm": (0.3, 0.7, 9),
+    "speed": (200.0, 800.0, 25),
+    "hatch_spacing": (0.2, 0.6, 9),
+}
+
+
+class ProcessWindowLUT:
+    """
+    Width, layer height and t_ratio tabulated on a regular (power, rpm, speed,
+    hatch_spacing) grid for fixed geometry settings.
+
+    `predict` is the fast mode: points inside the grid are interpolated
+    multilinearly from the table, the others are evaluated exactly with
+    `meltpool_geom_cal_batch`. The table is stored as `values.npy` (memory-mapped
+    when loaded) and `axes.npz` in a directory.
+    """
+
+    def __init__(self, axes: dict, values: np.ndarray, settings: dict) -> None:
+        self.axes = {name: np.asarray(axes[name], dtype=float) for name in AXES}
+        # Shape (len(OUTPUTS), *grid shape), NaN where the exact path failed
+        self.values = values
+        self.settings = settings
+
+    @classmethod
+    def build(
+        cls,
+        axes=None,
+        rotate=True,
+        num_tracks=5,
+        num_layers=3,
+        workers=1,
+        chunk_size=4096,
+        progress=None,
+    ) -> "ProcessWindowLUT":
+        # `axes` maps each of AXES to its grid points; defaults to DEFAULT_GRID
+        if axes is None:
+            axes = {name: np.linspace(*DEFAULT_GRID[name]) for name in AXES}
+        axes = {name: np.unique(np.asarray(axes[name], dtype=float)) for name in AXES}
+        settings = {
+            "rotate": bool(rotate),
+            "num_tracks": int(num_tracks),
+            "num_layers": int(num_layers),
+            "model_hash": model_hash(),
+        }
+        grid = np.meshgrid(*(axes[name] for name in AXES), indexing="ij")
+        power, rpm, speed, hatch_spacing = (g.ravel() for g in grid)
+
+        values = np.full((len(OUTPUTS), power.size), np.nan)
+        for start in range(0, power.size, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            values[:, chunk] = _evaluate(
+                power[chunk],
+                speed[chunk],
+                rpm[chunk],
+                hatch_spacing[chunk],
+                settings,
+                workers,
+            )
+            if progress is not None:
+                progress(min(start + chunk_size, power.size), power.size)
+        return cls(axes, values.reshape(len(OUTPUTS), *grid[0].shape), settings)
+
+    def save(self, directory) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / "values.npy", np.asarray(self.values))
+        np.savez(
+            directory / "axes.npz",
+            settings=json.dumps(self.settings),
+            **self.axes,
+        )
+
+    @classmethod
+    def load(cls, directory, mmap=True) -> "ProcessWindowLUT":
+        directory = Path(directory)
+        with np.load(directory / "axes.npz") as data:
+            axes = {name: data[name] for name in AXES}
+            settings = json.loads(str(data["settings"]))
+        if settings["model_hash"] != model_hash():
+            raise ValueError(
+                f"Lookup table in {directory} was built with different ML models"
+            )
+        if settings.get("t_search", "linear") != "linear":
+            # Tables from before the bisect t_ratio search was removed
+            raise ValueError(
+                f"Lookup table in {directory} was built with the bisect t_ratio search"
+            )
+        values = np.load(directory / "values.npy", mmap_mode="r" if mmap else None)
+        return cls(axes, values, settings)
+
+    def contains(self, power, speed, rpm, hatch_spacing) -> np.ndarray:
+        # An axis with a single point only contains that exact value
+        inside = True
+        for axis, x in zip(
+            self.axes.values(), _grid_order(power, speed, rpm, hatch_spacing)
+        ):
+            inside = inside & (x >= axis[0]) & (x <= axis[-1])
+        return inside
+
+    def interpolate(self, power, speed, rpm, hatch_spacing) -> tuple:
+        # Multilinear interpolation; NaN outside the grid or next to a failed point.
+        # An axis with a single point (e.g. a fixed hatch spacing) is constant
+        points = _grid_order(power, speed, rpm, hatch_spacing)
+        lower, fraction = [], []
+        for axis, x in zip(self.axes.values(), points):
+            if len(axis) == 1:
+                lower.append(np.zeros(len(x), dtype=int))
+                fraction.append(np.zeros(len(x)))
+                continue
+            i = np.clip(np.searchsorted(axis, x, side="right") - 1, 0, len(axis) - 2)
+            lower.append(i)
+            fraction.append((x - axis[i]) / (axis[i + 1] - axis[i]))
+
+        result = np.zeros((len(OUTPUTS), len(lower[0])))
+        bits = [(0, 1) if len(axis) > 1 else (0,) for axis in self.axes.values()]
+        for corner in itertools.product(*bits):
+            weight = np.ones(len(lower[0]))
+            for bit, f in zip(corner, fraction):
+                weight *= f if bit else 1 - f
+            index = tuple(i + bit for i, bit in zip(lower, corner))
+            result += weight * self.values[(slice(None), *index)]
+        result[:, ~self.contains(power, speed, rpm, hatch_spacing)] = np.nan
+        return tuple(result)
+
+    def predict(self, power, speed, rpm, hatch_spacing, fallback=True) -> tuple:
+        """
+        Fast mode: interpolated width, layer height and t_ratio. Points the table
+        cannot answer are evaluated exactly, or left as NaN with `fallback=False`
+        (and also when the exact path fails for them).
+        """
+        power, speed, rpm, hatch_spacing = np.broadcast_arrays(
+            *(
+                np.atleast_1d(np.asarray(v, dtype=float))
+                for v in (power, speed, rpm, hatch_spacing)
+            )
+        )
+        result = np.array(self.interpolate(power, speed, rpm, hatch_spacing))
+        missing = np.isnan(result).any(axis=0)
+        if fallback and missing.any():
+            result[:, missing] = _evaluate(
+                power[missing],
+                speed[missing],
+                rpm[missing],
+                hatch_spacing[missing],
+                self.settings,
+                workers=1,
+            )
+        return tuple(result)
+
+    def error_report(self, samples=200, seed=0) -> dict:
+        """
+        Interpolation error and speed of the fast mode against the exact path on
+        random points inside the grid.
+        """
+        rng = np.random.default_rng(seed)
+        power, rpm, speed, hatch_spacing = (
+            rng.uniform(axis[0], axis[-1], samples) for axis in self.axes.values()
+        )
+        args = (power, speed, rpm, hatch_spacing)
+
+        start = time.perf_counter()
+        fast = np.array(self.interpolate(*args))
+        fast_time = time.perf_counter() - start
+        start = time.perf_counter()
+        exact = _evaluate(*args, self.settings, workers=1)
+        exact_time = time.perf_counter() - start
+
+        error = np.abs(fast - exact)
+        report = {"samples": samples}
+        for name, e in zip(OUTPUTS, error):
+            report[f"{name}_max_abs_error"] = float(np.nanmax(e))
+            report[f"{name}_mean_abs_error"] = float(np.nanmean(e))
+        report["fast_us_per_row"] = fast_time / samples * 1e6
+        report["exact_us_per_row"] = exact_time / samples * 1e6
+        return report
+
+
+def _grid_order(power, speed, rpm, hatch_spacing) -> list:
+    # Broadcast 1-D arrays in the order of AXES
+    return np.broadcast_arrays(
+        *(
+            np.atleast_1d(np.asarray(v, dtype=float))
+            for v in (power, rpm, speed, hatch_spacing)
+        )
+    )
+
+
+def _evaluate(power, speed, rpm, hatch_spacing, settings, workers) -> np.ndarray:
+    # Exact values for a chunk of grid points, NaN for the points that fail
+    kwargs = dict(
+        rotate=settings["rotate"],
+        num_tracks=settings["num_tracks"],
+        num_layers=settings["num_layers"],
+    )
+    try:
+        return np.array(
+            meltpool_geom_cal_batch(
+                power, speed, rpm, hatch_spacing, workers=workers, **kwargs
+            )
+        )
+    except Exception:
+        values = np.full((len(OUTPUTS), len(power)), np.nan)
+        for i in range(len(power)):
+            try:
+                values[:, i] = np.ravel(
+                    meltpool_geom_cal_batch(
+                        power[i], speed[i], rpm[i], hatch_spacing[i], **kwargs
+                    )
+                )
+            except Exception:
+                pass
+        return values
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build or check a lookup table")
+    parser.add_argument("command", choices=("build", "report"))
+    parser.add_argument("directory")
+    for name in AXES:
+        low, high, points = DEFAULT_GRID[name]
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=float,
+            nargs=3,
+            metavar=("MIN", "MAX", "POINTS"),
+            default=(low, high, points),
+        )
+    parser.add_argument("--num-tracks", type=int, default=5)
+    parser.add_argument("--num-layers", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    use_server()
+
+    if args.command == "build":
+        axes = {}
+        for name in AXES:
+            low, high, points = getattr(args, name)
+            axes[name] = np.linspace(low, high, int(points))
+        lut = ProcessWindowLUT.build(
+            axes,
+            num_tracks=args.num_tracks,
+            num_layers=args.num_layers,
+            workers=args.workers,
+            progress=lambda done, total: print(f"{done}/{total} grid points"),
+        )
+        lut.save(args.directory)
+    else:
+        lut = ProcessWindowLUT.load(args.directory)
+    for name, value in lut.error_report(args.samples).items():
+        print(f"{name:>26}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-lived ML worker that keeps the models loaded for other processes
+
+    python src/ml_server.py start
+
+loads the models once and evaluates `meltpool_geom_cal_batch` and
+`meltpool_geom_sweep` requests from G.L.O.W. and the command line tools over a
+local socket, until `python src/ml_server.py stop`. Clients call `use_server()`
+to send their batches to it, and keep evaluating in their own process when no
+server is running.
+
+The address and a random key are written to a file only readable by the user
+(GLOW_ML_SERVER_FILE, by default ~/.glow/ml_server.json); connections without
+the key are refused.
+"""
+
+import argparse
+import json
+import os
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+from ml import (
+    meltpool_geom_cal_batch,
+    meltpool_geom_sweep,
+    model_hash,
+    models,
+    profiler,
+    release_memory,
+)
+
+# Functions clients may call, by name
+FUNCTIONS = {
+    "meltpool_geom_cal_batch": meltpool_geom_cal_batch,
+    "meltpool_geom_sweep": meltpool_geom_sweep,
+}
+
+
+def server_file() -> Path:
+    return Path(
+        os.environ.get("GLOW_ML_SERVER_FILE", Path.home() / ".glow" / "ml_server.json")
+    )
+
+
+class MLServer:
+    """
+    Serves requests from any number of clients, one thread per connection. The
+    evaluations themselves run one at a time, in the order they arrive.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = Path(path) if path is not None else server_file()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._key = None
+        self._stopping = False
+
+    def serve(self) -> None:
+        models.load()
+        self._key = key = os.urandom(32)
+        self._listener = Listener(("127.0.0.1", 0), authkey=key)
+        host, port = self._listener.address
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.unlink(missing_ok=True)
+        descriptor = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, "w") as file:
+            json.dump({"host": host, "port": port, "key": key.hex()}, file)
+        print(f"ML server listening on {host}:{port} ({models.active_backend})")
+        try:
+            while True:
+                try:
+                    connection = self._listener.accept()
+                except (AuthenticationError, ConnectionError, EOFError):
+                    # A client without the key, or one that left during the handshake
+                    continue
+                if self._stopping:
+                    connection.close()
+                    break
+                threading.Thread(
+                    target=self._handle, args=(connection,), daemon=True
+                ).start()
+        finally:
+            self._listener.close()
+            self.path.unlink(missing_ok=True)
+
+    def stop(self) -> None:
+        # accept() does not return when the listener is closed from another
+        # thread, so it is woken up by a last connection
+        self._stopping = True
+        Client(self._listener.address, authkey=self._key).close()
+
+    def _handle(self, connection) -> None:
+        with connection:
+            while True:
+                try:
+                    command, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result = ("ok", self._run(command, args, kwargs))
+                except Exception as e:
+                    result = ("error", e)
+                try:
+                    connection.send(result)
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    # The result or exception could not be pickled
+                    connection.send(("error", RuntimeError(repr(e))))
+                if command == "stop":
+                    self.stop()
+                    return
+
+    def _run(self, command, args, kwargs):
+        if command == "status":
+            return {
+                "pid": os.getpid(),
+                "backend": models.active_backend,
+                "model_hash": model_hash(),
+            }
+        if command == "stop":
+            return None
+        function = FUNCTIONS[command]
+        profile = kwargs.pop("profile", False)
+        with self._lock:
+            profiler.reset()
+            if profile:
+                profiler.enable()
+            try:
+                return function(*args, **kwargs), profiler.stats
+            finally:
+                profiler.disable()
+                release_memory()
+
+
+class MLServerClient:
+    """
+    Connection to a running `MLServer`, which may be shared between threads.
+    """
+
+    def __init__(self, connection) -> None:
+        self._connection = connection
+        self._lock = threading.Lock()
+
+    def request(self, command: str, *args, **kwargs):
+        # Raises again the exception of a failed request
+        with self._lock:
+            self._connection.send((command, args, kwargs))
+            status, value = self._connection.recv()
+        if status == "error":
+            raise value
+        return value
+
+    def call(self, function: str, *args, **kwargs):
+        # Stage timings are collected by the server when profiling here
+        result, stats = self.request(
+            function, *args, profile=profiler.enabled, **kwargs
+        )
+        profiler.merge(stats)
+        return result
+
+    def status(self) -> dict:
+        return self.request("status")
+
+    def stop(self) -> None:
+        self.request("stop")
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def connect(path=None):
+    # Returns an MLServerClient, or None when no server answers
+    path = Path(path) if path is not None else server_file()
+    try:
+        settings = json.loads(path.read_text())
+        connection = Client(
+            (settings["host"], settings["port"]),
+            authkey=bytes.fromhex(settings["key"]),
+        )
+    except (OSError, ValueError, KeyError, AuthenticationError):
+        return None
+    client = MLServerClient(connection)
+    try:
+        status = client.status()
+    except (OSError, EOFError):
+        return None
+    if status["model_hash"] != model_hash():
+        # The server was started with other model files
+        client.close()
+        return None
+    return client
+
+
+def use_server(path=None) -> bool:
+    """
+    Sends the ML batches of this process to the running server, if any. Returns
+    whether one was found.
+    """
+    client = connect(path)
+    if client is not None:
+        models.use_remote(client)
+    return client is not None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Persistent ML worker")
+    parser.add_argument("command", choices=("start", "stop", "status"))
+    parser.add_argument("--file", help="server file (default: GLOW_ML_SERVER_FILE)")
+    args = parser.parse_args()
+
+    if args.command == "start":
+        if connect(args.file) is not None:
+            parser.exit(1, "An ML server is already running\n")
+        try:
+            MLServer(args.file).serve()
+        except KeyboardInterrupt:
+            pass
+        return
+    client = connect(args.file)
+    if client is None:
+        parser.exit(1, "No ML server is running\n")
+    if args.command == "stop":
+        client.stop()
+    else:
+        for name, value in client.status().items():
+            print(f"{name:>10}: {value}")
+
+
+if __name__ == "__main__":
+    main()